@@ -2,14 +2,30 @@ from nvflare.apis.shareable import Shareable
 from nvflare.apis.fl_context import FLContext
 from nvflare.app_common.abstract.aggregator import Aggregator
 from nvflare.apis.fl_constant import ReservedKey
-from .get_global_average import get_global_average
+
+from common.constants import PERF_HEADER
+from .get_global_average import (
+    get_global_average, new_partial_sum, add_to_partial_sum, finalize_partial_sum, is_partial_sum_result,
+)
 
 
 class AverageAggregator(Aggregator):
-    def __init__(self):
+    def __init__(self, streaming: bool = True):
+        """
+        Args:
+            streaming: fold each contribution into a running weighted sum as it arrives instead of
+                storing every contributor's result until the end of the round.
+        """
         super().__init__()
-        # Initialize stored_data to hold contributions per round and contributor
+        self.streaming = streaming
+        # Initialize stored_data to hold contributions per round and contributor (non-streaming mode)
         self.stored_data = {}  # Structure: {round_number: {contributor_name: data}}
+        # Running weighted sums per round (streaming mode)
+        self.partial_sums = {}  # Structure: {round_number: partial_sum}
+        # Contributors accepted so far per round, used to reject duplicate submissions
+        self.contributors = {}  # Structure: {round_number: set(contributor_name)}
+        # Stage records (common.profiling) attached to accepted contributions, by site
+        self.perf_records = {}  # Structure: {round_number: {site_name: record}}
 
     def accept(self, shareable: Shareable, fl_ctx: FLContext) -> bool:
         """Accepts shareable contributions for aggregation.
@@ -19,7 +35,7 @@ class AverageAggregator(Aggregator):
             fl_ctx: The federated learning context.
 
         Returns:
-            bool: True indicating acceptance of the shareable data.
+            bool: True if the contribution was accepted, False if it was invalid or a duplicate.
         """
         contribution_round = fl_ctx.get_prop(key="CURRENT_ROUND", default=None)
         contributor_name = shareable.get_peer_prop(key=ReservedKey.IDENTITY_NAME, default=None)
@@ -32,15 +48,37 @@ class AverageAggregator(Aggregator):
         if contribution_round is None or contributor_name is None:
             return False  # Could log a warning/error here as well
 
-        if contribution_round not in self.stored_data:
-            self.stored_data[contribution_round] = {}
+        round_contributors = self.contributors.setdefault(contribution_round, set())
+        if contributor_name in round_contributors:
+            print(f"Aggregator rejected duplicate contribution from {contributor_name} for round {contribution_round}")
+            return False
+
+        result = shareable.get("result", {})
+        # either a site result or the partial sum of a subtree forwarded by an IntermediateAggregator
+        if not result or ("count" not in result and not is_partial_sum_result(result)):
+            return False
+
+        if self.streaming:
+            partial_sum = self.partial_sums.setdefault(contribution_round, new_partial_sum())
+            try:
+                add_to_partial_sum(partial_sum, result)
+            except ValueError as e:
+                print(f"Aggregator rejected contribution from {contributor_name}: {e}")
+                return False
+        else:
+            self.stored_data.setdefault(contribution_round, {})[contributor_name] = result
+
+        round_contributors.add(contributor_name)
 
-        # It's assumed shareable.get("result", {}) correctly fetches the data dict
-        self.stored_data[contribution_round][contributor_name] = shareable.get("result", {})
+        perf_record = shareable.get_header(PERF_HEADER)
+        if perf_record:
+            round_records = self.perf_records.setdefault(contribution_round, {})
+            # a forwarded subtree carries the records of its sites
+            round_records.update(perf_record.get("sites", {contributor_name: perf_record}))
         return True
 
     def aggregate(self, fl_ctx: FLContext) -> Shareable:
-        """Aggregates contributions for the current round into a global average.
+        """Aggregates contributions for the current round into a global average and frees the round's state.
 
         Args:
             fl_ctx: The federated learning context.
@@ -49,19 +87,42 @@ class AverageAggregator(Aggregator):
             Shareable: A shareable containing the global average.
         """
         contribution_round = fl_ctx.get_prop(key="CURRENT_ROUND", default=None)
-        data_for_aggregation = []
-        
-        if contribution_round in self.stored_data and self.stored_data[contribution_round]:
-            for data in self.stored_data[contribution_round].values():
-                data_for_aggregation.append(data)
-                
-            # get the computation parameters
-            #computation_parameters = fl_ctx.get_prop("COMPUTATION_PARAMETERS")
-
-            global_average = get_global_average(data_for_aggregation)
-            outgoing_shareable = Shareable()
-            outgoing_shareable["global_average"] = global_average
-
-            return outgoing_shareable
+
+        self.contributors.pop(contribution_round, None)
+        partial_sum = self.partial_sums.pop(contribution_round, None)
+        round_data = self.stored_data.pop(contribution_round, None)
+        # stage records are kept for the workflow to collect until the next aggregation, so they do not pile up
+        # when sites profile but the workflow does not
+        self.perf_records = {contribution_round: self.perf_records.get(contribution_round, {})}
+
+        # get the computation parameters
+        #computation_parameters = fl_ctx.get_prop("COMPUTATION_PARAMETERS")
+
+        if partial_sum is not None:
+            global_average = finalize_partial_sum(partial_sum)
+        elif round_data:
+            global_average = get_global_average(list(round_data.values()))
         else:
             return Shareable()  # Return an empty Shareable if no data to aggregate
+
+        outgoing_shareable = Shareable()
+        outgoing_shareable["global_average"] = global_average
+
+        return outgoing_shareable
+
+    def pop_perf_records(self, contribution_round) -> dict:
+        """Stage records of the sites that contributed to contribution_round, by site name."""
+        return self.perf_records.pop(contribution_round, {})
+
+    def get_state(self) -> dict:
+        """State of the rounds not aggregated yet, for workflow snapshots."""
+        return {
+            "stored_data": self.stored_data,
+            "partial_sums": self.partial_sums,
+            "contributors": self.contributors,
+        }
+
+    def set_state(self, state: dict):
+        self.stored_data = state["stored_data"]
+        self.partial_sums = state["partial_sums"]
+        self.contributors = state["contributors"]
@@ -1,20 +1,228 @@
 from typing import List, Dict
 import numpy as np
 
+from common.packing import (
+    as_edge_vector, densify_vector, is_packed, is_sparse, num_edges_from_nodes, num_nodes_from_edges, pack_vector,
+    sparse_vector, unpack_sparse, vec_to_full_matrix,
+)
+
 
 def get_global_average(items: List[Dict[str, float]]):
-    """Accepts a list of dicts and returns the weighted global average of the data."""
+    """Accepts a list of dicts and returns the weighted global average of the data.
+
+    dp_fc_mean may be a packed upper triangle (see common.packing) or a legacy full matrix; the weighted
+    sum is taken over the edge vectors in float64 and the result is packed in the dtype of the first
+    contribution, or returned as a full matrix when the contributions were full matrices.
+
+    Sparse contributions (common.packing.sparsify_vector) only count for the edges they contain: every
+    edge is averaged over the sites that sent it, and the result is sparse, holding every edge that any
+    site sent.
+    """
     if not items:
         return 0  # Return 0 or suitable default if items list is empty
-    
-    counts = [item["count"] for item in items]
-    total_count = sum(counts)
-    if total_count == 0:
+
+    partial_sum = new_partial_sum()
+    for item in items:
+        add_to_partial_sum(partial_sum, item)
+
+    return finalize_partial_sum(partial_sum)
+
+
+def new_partial_sum() -> Dict:
+    """Running (weighted sum, count) state of the weighted mean, filled by add_to_partial_sum. Once a sparse
+    contribution arrives, edge_counts holds the summed count of the sites that sent each edge."""
+    return {"weighted_sum": None, "total_count": 0, "counts": [], "dtype": None, "edge_counts": None}
+
+
+def add_to_partial_sum(partial_sum: Dict, item: Dict) -> Dict:
+    """Folds one site result (or a forwarded partial sum) into partial_sum in place, so only one
+    edges-length vector is kept."""
+    if is_partial_sum_result(item):
+        return merge_partial_sums(partial_sum, partial_sum_from_result(item))
+    if "variants" in item:
+        return add_variants_to_partial_sum(partial_sum, item)
+    if "variants" in partial_sum:
+        raise ValueError("a single-configuration result cannot be combined with multi-configuration results")
+
+    count = item["count"]
+    dp_fc_mean = item["dp_fc_mean"]
+    if is_sparse(dp_fc_mean):
+        num_edges = num_edges_from_nodes(dp_fc_mean["num_nodes"])
+    else:
+        dp_fc_vec = as_edge_vector(dp_fc_mean)
+        num_edges = len(dp_fc_vec)
+
+    if partial_sum["weighted_sum"] is None:
+        partial_sum["weighted_sum"] = np.zeros(num_edges)
+        partial_sum["dtype"] = dp_fc_mean["dtype"] if is_packed(dp_fc_mean) or is_sparse(dp_fc_mean) else None
+    if len(partial_sum["weighted_sum"]) != num_edges:
+        raise ValueError("results have different numbers of nodes")
+
+    if is_sparse(dp_fc_mean):
+        indices, values = unpack_sparse(dp_fc_mean)
+        edge_counts = get_edge_counts(partial_sum)
+        # the indices of a contribution are unique, so the fancy-indexed += is a scatter-add
+        partial_sum["weighted_sum"][indices] += values.astype(np.float64) * count
+        edge_counts[indices] += count
+    else:
+        partial_sum["weighted_sum"] += dp_fc_vec.astype(np.float64) * count
+        if partial_sum.get("edge_counts") is not None:
+            partial_sum["edge_counts"] += count
+    partial_sum["total_count"] += count
+    partial_sum["counts"].append(count)
+
+    return partial_sum
+
+
+def get_edge_counts(partial_sum: Dict) -> np.ndarray:
+    """Per-edge counts of partial_sum, set up on the first sparse contribution: the dense contributions
+    before it sent every edge."""
+    if partial_sum.get("edge_counts") is None:
+        partial_sum["edge_counts"] = np.full(len(partial_sum["weighted_sum"]), float(partial_sum["total_count"]))
+    return partial_sum["edge_counts"]
+
+
+def add_variants_to_partial_sum(partial_sum: Dict, item: Dict) -> Dict:
+    """Folds a multi-configuration site result (see executor.local_average.get_local_variants) into
+    partial_sum in place, keeping one weighted sum per variant."""
+    variants = item["variants"]
+    init_variants(partial_sum, [
+        {key: value for key, value in variant.items() if key != "dp_fc_mean"} for variant in variants
+    ])
+
+    for variant_sum, variant in zip(partial_sum["variants"], variants):
+        add_to_partial_sum(variant_sum, {"dp_fc_mean": variant["dp_fc_mean"], "count": item["count"]})
+    partial_sum["total_count"] += item["count"]
+    partial_sum["counts"].append(item["count"])
+
+    return partial_sum
+
+
+def init_variants(partial_sum: Dict, variant_parameters: List[Dict]):
+    """Sets up the per-variant sums of an empty partial sum, or checks that the configurations match."""
+    if "variants" not in partial_sum:
+        if partial_sum["weighted_sum"] is not None:
+            raise ValueError("a multi-configuration result cannot be combined with single-configuration results")
+        partial_sum["variants"] = [new_partial_sum() for _ in variant_parameters]
+        partial_sum["variant_parameters"] = variant_parameters
+    elif partial_sum["variant_parameters"] != variant_parameters:
+        raise ValueError("results were computed for different configurations")
+
+
+def merge_partial_sums(partial_sum: Dict, other: Dict) -> Dict:
+    """Adds other into partial_sum in place. The weighted mean is associative over (weighted sum, count)
+    pairs, so subtrees can be pre-combined in any grouping."""
+    if "variants" in other:
+        init_variants(partial_sum, other["variant_parameters"])
+        for variant_sum, other_variant_sum in zip(partial_sum["variants"], other["variants"]):
+            merge_partial_sums(variant_sum, other_variant_sum)
+        partial_sum["total_count"] += other["total_count"]
+        partial_sum["counts"].extend(other["counts"])
+        return partial_sum
+
+    if other["weighted_sum"] is None:
+        return partial_sum
+    if "variants" in partial_sum:
+        raise ValueError("a single-configuration result cannot be combined with multi-configuration results")
+
+    other_edge_counts = other.get("edge_counts")
+    if partial_sum["weighted_sum"] is None:
+        partial_sum["weighted_sum"] = np.array(other["weighted_sum"], dtype=np.float64)
+        partial_sum["dtype"] = other["dtype"]
+        if other_edge_counts is not None:
+            partial_sum["edge_counts"] = np.array(other_edge_counts, dtype=np.float64)
+    else:
+        if len(partial_sum["weighted_sum"]) != len(other["weighted_sum"]):
+            raise ValueError("results have different numbers of nodes")
+        partial_sum["weighted_sum"] += other["weighted_sum"]
+        if other_edge_counts is not None or partial_sum.get("edge_counts") is not None:
+            get_edge_counts(partial_sum)
+            partial_sum["edge_counts"] += other["total_count"] if other_edge_counts is None else other_edge_counts
+    partial_sum["total_count"] += other["total_count"]
+    partial_sum["counts"].extend(other["counts"])
+
+    return partial_sum
+
+
+def partial_sum_result(partial_sum: Dict) -> Dict:
+    """Wire form of a partial sum, forwarded by an intermediate aggregator in place of a site result.
+    The weighted sum stays float64 so the final average does not depend on the tree shape. Sums of sparse
+    contributions are forwarded sparse, as the edges any site sent with their sums and counts."""
+    result = {
+        "weighted_sum": None,
+        "total_count": partial_sum["total_count"],
+        "counts": list(partial_sum["counts"]),
+        "dtype": partial_sum["dtype"],
+        "edge_counts": None,
+    }
+    edge_counts = partial_sum.get("edge_counts")
+    if edge_counts is not None:
+        indices = np.flatnonzero(edge_counts)
+        num_nodes = num_nodes_from_edges(len(edge_counts))
+        result["weighted_sum"] = sparse_vector(indices, partial_sum["weighted_sum"][indices], num_nodes, "float64")
+        result["edge_counts"] = sparse_vector(indices, edge_counts[indices], num_nodes, "float64")
+    elif partial_sum["weighted_sum"] is not None:
+        result["weighted_sum"] = pack_vector(partial_sum["weighted_sum"], "float64")
+    if "variants" in partial_sum:
+        result["variants"] = [partial_sum_result(variant_sum) for variant_sum in partial_sum["variants"]]
+        result["variant_parameters"] = partial_sum["variant_parameters"]
+    return result
+
+
+def is_partial_sum_result(item: Dict) -> bool:
+    return "weighted_sum" in item
+
+
+def partial_sum_from_result(item: Dict) -> Dict:
+    weighted_sum, edge_counts = item["weighted_sum"], item.get("edge_counts")
+    partial_sum = {
+        "weighted_sum": None if weighted_sum is None else as_edge_vector(weighted_sum),
+        "total_count": item["total_count"],
+        "counts": item["counts"],
+        "dtype": item["dtype"],
+        "edge_counts": None if edge_counts is None else densify_vector(edge_counts),
+    }
+    if "variants" in item:
+        partial_sum["variants"] = [partial_sum_from_result(variant) for variant in item["variants"]]
+        partial_sum["variant_parameters"] = item["variant_parameters"]
+    return partial_sum
+
+
+def is_empty_partial_sum(partial_sum: Dict) -> bool:
+    return partial_sum["weighted_sum"] is None and "variants" not in partial_sum
+
+
+def finalize_partial_sum(partial_sum: Dict):
+    """Turns a partial sum into the global average dict returned by get_global_average. Multi-configuration
+    sums give {"variants": [{<configuration>, "dp_fc_mean"}, ...], "counts"}."""
+    if "variants" in partial_sum:
+        if partial_sum["total_count"] == 0:
+            return 0
+        variants = [
+            {**parameters, "dp_fc_mean": finalize_partial_sum(variant_sum)["dp_fc_mean"]}
+            for parameters, variant_sum in zip(partial_sum["variant_parameters"], partial_sum["variants"])
+        ]
+        return {"variants": variants, "counts": list(partial_sum["counts"])}
+
+    total_count = partial_sum["total_count"]
+    if partial_sum["weighted_sum"] is None or total_count == 0:
         return 0  # Avoid division by zero
 
-    weighted_dp_fc = sum(np.array(item["dp_fc_mean"]) * item["count"] for item in items)
-    global_dp_fc_mean = (weighted_dp_fc / total_count).tolist()
-    
-    global_average = {"dp_fc_mean": global_dp_fc_mean, "counts": counts}
+    edge_counts = partial_sum.get("edge_counts")
+    if edge_counts is not None:
+        # every edge is averaged over the sites that sent it
+        indices = np.flatnonzero(edge_counts)
+        values = partial_sum["weighted_sum"][indices] / edge_counts[indices]
+        global_dp_fc_mean = sparse_vector(indices, values, num_nodes_from_edges(len(edge_counts)), partial_sum["dtype"])
+        return {"dp_fc_mean": global_dp_fc_mean, "counts": list(partial_sum["counts"])}
+
+    global_dp_fc_vec = partial_sum["weighted_sum"] / total_count
+
+    if partial_sum["dtype"] is not None:
+        global_dp_fc_mean = pack_vector(global_dp_fc_vec, partial_sum["dtype"])
+    else:
+        global_dp_fc_mean = vec_to_full_matrix(global_dp_fc_vec).tolist()
+
+    global_average = {"dp_fc_mean": global_dp_fc_mean, "counts": list(partial_sum["counts"])}
 
     return global_average
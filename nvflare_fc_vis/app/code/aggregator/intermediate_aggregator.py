@@ -0,0 +1,72 @@
+from typing import Dict
+
+import yaml
+from nvflare.apis.shareable import Shareable
+from nvflare.apis.fl_context import FLContext
+
+from common.constants import APPLIED_PARAMETERS_HEADER, PERF_HEADER
+from .average_aggregator import AverageAggregator
+from .get_global_average import partial_sum_result, is_empty_partial_sum
+
+
+class IntermediateAggregator(AverageAggregator):
+    """Inner node of a tree aggregation.
+
+    Accepts the results of its children (sites or other intermediate aggregators) like AverageAggregator,
+    but aggregate returns the subtree's partial sum as a "result" instead of the finalized average. The
+    parent accepts it like any site result, so the server receives one contribution per subtree and the
+    final average is the same as with flat aggregation.
+
+    The partial sum reports the computation parameters its children applied if they all applied the same,
+    so a child that did not apply the job's parameters fails the job as it would without the tree.
+    """
+
+    def __init__(self):
+        super().__init__(streaming=True)
+        # APPLIED_PARAMETERS_HEADER of every child result per round
+        self.applied_parameters = {}  # Structure: {round_number: [applied parameters]}
+
+    def accept(self, shareable: Shareable, fl_ctx: FLContext) -> bool:
+        contribution_round = fl_ctx.get_prop(key="CURRENT_ROUND", default=None)
+        # recorded for rejected results too, a failed site must not drop out of the check unnoticed
+        self.applied_parameters.setdefault(contribution_round, []).append(
+            shareable.get_header(APPLIED_PARAMETERS_HEADER)
+        )
+        return super().accept(shareable, fl_ctx)
+
+    def aggregate(self, fl_ctx: FLContext) -> Shareable:
+        """Returns the partial sum of the current round's contributions and frees the round's state.
+
+        Args:
+            fl_ctx: The federated learning context.
+
+        Returns:
+            Shareable: A shareable with the partial sum under "result", empty if nothing was accepted.
+        """
+        contribution_round = fl_ctx.get_prop(key="CURRENT_ROUND", default=None)
+
+        self.contributors.pop(contribution_round, None)
+        partial_sum = self.partial_sums.pop(contribution_round, None)
+        applied_parameters = self.applied_parameters.pop(contribution_round, [])
+
+        outgoing_shareable = Shareable()
+        if partial_sum is not None and not is_empty_partial_sum(partial_sum):
+            outgoing_shareable["result"] = partial_sum_result(partial_sum)
+        if applied_parameters and all(applied == applied_parameters[0] for applied in applied_parameters):
+            outgoing_shareable.set_header(APPLIED_PARAMETERS_HEADER, applied_parameters[0])
+        perf_records = self.pop_perf_records(contribution_round)
+        if perf_records:
+            outgoing_shareable.set_header(PERF_HEADER, {"sites": perf_records})
+
+        return outgoing_shareable
+
+
+def site_groups_from_project(project_file_path: str) -> Dict[str, str]:
+    """Maps each client in an NVFlare project.yaml to its org, the default grouping for tree aggregation."""
+    with open(project_file_path, "r") as file:
+        project = yaml.safe_load(file)
+    return {
+        participant["name"]: participant["org"]
+        for participant in project.get("participants", [])
+        if participant.get("type") == "client"
+    }
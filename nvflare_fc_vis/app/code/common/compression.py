@@ -0,0 +1,193 @@
+"""
+Compression of packed matrices (see common.packing) for transport.
+
+Packed arrays are byte-shuffled (all first bytes of the values, then all second bytes, ...), which
+groups the slowly varying sign/exponent bytes together, and then compressed with zlib or, if installed,
+lz4. Optionally the values are quantized first, to float16 or to 8-bit levels over the value range,
+but only if the quantization error stays within max_error; otherwise the array is sent losslessly.
+Sparse matrices are compressed the same way, their ascending indices as (always lossless) differences.
+"""
+import copy
+import time
+import zlib
+
+import numpy as np
+
+from .packing import INDEX_DTYPE, PACKED_FORMAT, SPARSE_FORMAT, is_packed, is_sparse, unpack_sparse, unpack_vector
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # optional dependency
+    lz4_frame = None
+
+COMPRESSED_FORMAT = "compressed_triu"
+COMPRESSED_SPARSE_FORMAT = "compressed_sparse_triu"
+CODECS = ("zlib", "lz4")
+QUANTIZATIONS = (None, "float16", "uint8")
+
+
+def check_codec(codec: str):
+    if codec not in CODECS:
+        raise ValueError(f"codec must be one of {CODECS}, got {codec!r}")
+    if codec == "lz4" and lz4_frame is None:
+        raise ValueError("codec 'lz4' requires the lz4 package")
+
+
+def is_compressed(value) -> bool:
+    return isinstance(value, dict) and value.get("format") in (COMPRESSED_FORMAT, COMPRESSED_SPARSE_FORMAT)
+
+
+def shuffle_bytes(values: np.ndarray) -> bytes:
+    return np.ascontiguousarray(values).view(np.uint8).reshape(-1, values.dtype.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data: bytes, dtype) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).ravel()
+
+
+def quantize(values: np.ndarray, quantization: str, max_error: float):
+    """Returns (quantized values, metadata) or (None, None) if the error bound cannot be met."""
+    if quantization == "float16":
+        quantized = values.astype(np.float16)
+        error = np.max(np.abs(quantized.astype(values.dtype) - values), initial=0)
+        return (quantized, {}) if error <= max_error else (None, None)
+
+    low, high = (float(values.min()), float(values.max())) if len(values) else (0.0, 0.0)
+    scale = (high - low) / 255 if high > low else 1.0
+    # the rounding error of uniform 8-bit levels is at most half a step
+    if scale / 2 > max_error:
+        return None, None
+    quantized = np.rint((values - low) / scale).astype(np.uint8)
+    return quantized, {"offset": low, "scale": scale}
+
+
+def compress_array(values: np.ndarray, codec: str = "zlib", level: int = 6, quantization: str = None,
+                   max_error: float = 1e-3) -> dict:
+    """Compressed form of a 1-d array: stored_dtype, quantization, data and the quantization metadata."""
+    stored, metadata = None, {}
+    if quantization is not None:
+        stored, metadata = quantize(values, quantization, max_error)
+    if stored is None:
+        stored, quantization, metadata = values, None, {}
+
+    raw = shuffle_bytes(stored)
+    data = zlib.compress(raw, level) if codec == "zlib" else lz4_frame.compress(raw)
+
+    return {"stored_dtype": stored.dtype.name, "codec": codec, "quantization": quantization, "data": data, **metadata}
+
+
+def decompress_array(compressed: dict, dtype) -> np.ndarray:
+    codec = compressed["codec"]
+    check_codec(codec)
+    raw = zlib.decompress(compressed["data"]) if codec == "zlib" else lz4_frame.decompress(compressed["data"])
+    values = unshuffle_bytes(raw, compressed["stored_dtype"])
+
+    if compressed["quantization"] == "uint8":
+        values = values * compressed["scale"] + compressed["offset"]
+    return values.astype(dtype)
+
+
+def compress_packed(packed: dict, codec: str = "zlib", level: int = 6, quantization: str = None,
+                    max_error: float = 1e-3) -> dict:
+    return {
+        "format": COMPRESSED_FORMAT,
+        "num_nodes": packed["num_nodes"],
+        "dtype": packed["dtype"],
+        **compress_array(unpack_vector(packed), codec, level, quantization, max_error),
+    }
+
+
+def compress_sparse(sparse: dict, codec: str = "zlib", level: int = 6, quantization: str = None,
+                    max_error: float = 1e-3) -> dict:
+    indices, values = unpack_sparse(sparse)
+    return {
+        "format": COMPRESSED_SPARSE_FORMAT,
+        "num_nodes": sparse["num_nodes"],
+        "dtype": sparse["dtype"],
+        "indices": compress_array(np.diff(indices, prepend=indices.dtype.type(0)), codec, level),
+        **compress_array(values, codec, level, quantization, max_error),
+    }
+
+
+def decompress_packed(compressed: dict) -> dict:
+    """Restores a compressed packed or sparse matrix."""
+    if compressed["format"] == COMPRESSED_SPARSE_FORMAT:
+        return {
+            "format": SPARSE_FORMAT,
+            "num_nodes": compressed["num_nodes"],
+            "dtype": compressed["dtype"],
+            "indices": np.cumsum(decompress_array(compressed["indices"], INDEX_DTYPE), dtype=INDEX_DTYPE).tobytes(),
+            "data": decompress_array(compressed, compressed["dtype"]).tobytes(),
+        }
+
+    return {
+        "format": PACKED_FORMAT,
+        "num_nodes": compressed["num_nodes"],
+        "dtype": compressed["dtype"],
+        "data": decompress_array(compressed, compressed["dtype"]).tobytes(),
+    }
+
+
+def transform_payload(payload, transform, lossless_keys=(), key=None, lossless=False):
+    """
+    Returns a copy of payload with transform(value, lossless) applied to every packed, sparse or compressed
+    matrix nested in its dicts and lists. The dicts and lists are shallow-copied (keeping their type, e.g.
+    Shareable), payload itself is not modified. Values under a key in lossless_keys, at any depth, are
+    flagged as lossless.
+    """
+    lossless = lossless or key in lossless_keys
+    if is_packed(payload) or is_sparse(payload) or is_compressed(payload):
+        return transform(payload, lossless)
+    if isinstance(payload, dict):
+        payload = copy.copy(payload)
+        for child_key, value in payload.items():
+            payload[child_key] = transform_payload(value, transform, lossless_keys, child_key, lossless)
+    elif isinstance(payload, list):
+        payload = [transform_payload(value, transform, lossless_keys, key, lossless) for value in payload]
+    return payload
+
+
+def compress_payload(payload, codec: str = "zlib", level: int = 6, quantization: str = None,
+                     max_error: float = 1e-3, lossless_keys=("weighted_sum", "edge_counts")) -> dict:
+    """
+    Compresses every packed or sparse matrix in payload. Returns the compressed copy (payload is left as it
+    is) and size and timing statistics.
+    """
+    stats = {"arrays": 0, "raw_bytes": 0, "compressed_bytes": 0}
+    start = time.perf_counter()
+
+    def compress(value, lossless):
+        if is_packed(value):
+            compressed = compress_packed(value, codec, level, None if lossless else quantization, max_error)
+            stats["raw_bytes"] += len(value["data"])
+            stats["compressed_bytes"] += len(compressed["data"])
+        elif is_sparse(value):
+            compressed = compress_sparse(value, codec, level, None if lossless else quantization, max_error)
+            stats["raw_bytes"] += len(value["data"]) + len(value["indices"])
+            stats["compressed_bytes"] += len(compressed["data"]) + len(compressed["indices"]["data"])
+        else:
+            return value
+        stats["arrays"] += 1
+        return compressed
+
+    payload = transform_payload(payload, compress, lossless_keys)
+    stats["seconds"] = time.perf_counter() - start
+    stats["ratio"] = stats["raw_bytes"] / stats["compressed_bytes"] if stats["compressed_bytes"] else 1.0
+    return payload, stats
+
+
+def decompress_payload(payload) -> dict:
+    """Restores every compressed matrix in payload. Returns the restored copy and timing statistics."""
+    stats = {"arrays": 0}
+    start = time.perf_counter()
+
+    def decompress(value, lossless):
+        if not is_compressed(value):
+            return value
+        stats["arrays"] += 1
+        return decompress_packed(value)
+
+    payload = transform_payload(payload, decompress)
+    stats["seconds"] = time.perf_counter() - start
+    return payload, stats
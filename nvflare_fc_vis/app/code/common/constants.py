@@ -0,0 +1,14 @@
+# Shareable header carrying the round a task belongs to; sites echo it in their result so that results
+# arriving after the round was closed can still be attributed to it
+CURRENT_ROUND_HEADER = "current_round"
+
+# Shareable header carrying a common.profiling stage record of the task that produced the shareable
+PERF_HEADER = "perf_record"
+
+# Shareable header of a site result with the round of the piggybacked global average the site stored
+# before computing it (AverageWorkflow fuse_global_average)
+GLOBAL_AVERAGE_ACK_HEADER = "global_average_ack"
+
+# Shareable header of a site result with the job's computation_parameters the site applied (None if it ignored
+# them), so the workflow can tell results computed with the job's parameters from the site's defaults
+APPLIED_PARAMETERS_HEADER = "applied_parameters"
@@ -0,0 +1,127 @@
+from math import isqrt
+
+import numpy as np
+
+# wire format for symmetric FC matrices with a unit diagonal: only the strict upper triangle is sent,
+# row-major (np.triu_indices(num_nodes, 1) order), as raw bytes of the given dtype
+PACKED_FORMAT = "packed_triu"
+DEFAULT_WIRE_DTYPE = "float32"
+# sparse variant: only selected edges, as ascending positions in the packed edge vector ("indices") and
+# their values ("data"), both as raw bytes; edges that are not listed are unknown, not zero
+SPARSE_FORMAT = "sparse_triu"
+INDEX_DTYPE = "uint32"
+
+
+def num_nodes_from_edges(num_edges: int) -> int:
+    """Inverts num_edges = num_nodes * (num_nodes - 1) / 2 exactly (no floating point root finding)."""
+    num_nodes = (1 + isqrt(1 + 8 * int(num_edges))) // 2
+    if num_nodes * (num_nodes - 1) // 2 != num_edges:
+        raise ValueError(f"{num_edges} is not the number of edges of a complete graph")
+    return num_nodes
+
+
+def pack_vector(fc_vec, dtype=DEFAULT_WIRE_DTYPE) -> dict:
+    """Packs an upper-triangle edge vector into the wire format."""
+    fc_vec = np.asarray(fc_vec)
+    dtype = np.dtype(dtype)
+    return {
+        "format": PACKED_FORMAT,
+        "num_nodes": num_nodes_from_edges(len(fc_vec)),
+        "dtype": dtype.name,
+        "data": fc_vec.astype(dtype, copy=False).tobytes(),
+    }
+
+
+def pack_matrix(fc_mat, dtype=DEFAULT_WIRE_DTYPE) -> dict:
+    """Packs the strict upper triangle of a symmetric nodes x nodes matrix."""
+    fc_mat = np.asarray(fc_mat)
+    return pack_vector(fc_mat[np.triu_indices(len(fc_mat), 1)], dtype)
+
+
+def is_packed(value) -> bool:
+    return isinstance(value, dict) and value.get("format") == PACKED_FORMAT
+
+
+def unpack_vector(packed: dict) -> np.ndarray:
+    """Read-only view of the packed edge vector, no copy is made."""
+    return np.frombuffer(packed["data"], dtype=packed["dtype"])
+
+
+def unpack_matrix(packed: dict, diagonal=1.0) -> np.ndarray:
+    """Expands the packed form to the full symmetric matrix."""
+    return vec_to_full_matrix(unpack_vector(packed), diagonal)
+
+
+def vec_to_full_matrix(fc_vec, diagonal=1.0) -> np.ndarray:
+    num_nodes = num_nodes_from_edges(len(fc_vec))
+    rows, cols = np.triu_indices(num_nodes, 1)
+    fc_mat = np.empty((num_nodes, num_nodes), dtype=np.result_type(fc_vec, np.float32))
+    fc_mat[rows, cols] = fc_vec
+    fc_mat[cols, rows] = fc_vec
+    np.fill_diagonal(fc_mat, diagonal)
+    return fc_mat
+
+
+def num_edges_from_nodes(num_nodes: int) -> int:
+    return num_nodes * (num_nodes - 1) // 2
+
+
+def sparse_vector(indices, values, num_nodes: int, dtype=DEFAULT_WIRE_DTYPE) -> dict:
+    """Packs the edges at the given (ascending) indices of the edge vector into the sparse wire format."""
+    return {
+        "format": SPARSE_FORMAT,
+        "num_nodes": num_nodes,
+        "dtype": np.dtype(dtype).name,
+        "indices": np.asarray(indices).astype(INDEX_DTYPE, copy=False).tobytes(),
+        "data": np.asarray(values).astype(dtype, copy=False).tobytes(),
+    }
+
+
+def sparsify_vector(fc_vec, top_k: int = None, threshold: float = None, dtype=None) -> dict:
+    """
+    Sparse form of an edge vector with the edges whose absolute value is at least threshold, and of those
+    only the top_k strongest. None disables either criterion. dtype defaults to the dtype of fc_vec.
+    """
+    fc_vec = np.asarray(fc_vec)
+    strength = np.abs(fc_vec)
+    indices = np.arange(len(fc_vec)) if threshold is None else np.flatnonzero(strength >= threshold)
+    if top_k is not None and top_k < len(indices):
+        strongest = np.argpartition(strength[indices], len(indices) - top_k)[len(indices) - top_k:]
+        indices = np.sort(indices[strongest])
+    return sparse_vector(indices, fc_vec[indices], num_nodes_from_edges(len(fc_vec)), dtype or fc_vec.dtype)
+
+
+def is_sparse(value) -> bool:
+    return isinstance(value, dict) and value.get("format") == SPARSE_FORMAT
+
+
+def unpack_sparse(sparse: dict):
+    """Read-only views of the (indices, values) of a sparse matrix, no copy is made."""
+    return np.frombuffer(sparse["indices"], dtype=INDEX_DTYPE), np.frombuffer(sparse["data"], dtype=sparse["dtype"])
+
+
+def densify_vector(sparse: dict, fill=0.0) -> np.ndarray:
+    """Full edge vector of a sparse matrix, with fill for the edges that were not sent."""
+    indices, values = unpack_sparse(sparse)
+    fc_vec = np.full(num_edges_from_nodes(sparse["num_nodes"]), fill, dtype=values.dtype)
+    fc_vec[indices] = values
+    return fc_vec
+
+
+def as_edge_vector(value) -> np.ndarray:
+    """Edge vector of a packed or sparse matrix or of a legacy full matrix given as nested lists."""
+    if is_packed(value):
+        return unpack_vector(value)
+    if is_sparse(value):
+        return densify_vector(value)
+    fc_mat = np.asarray(value)
+    return fc_mat[np.triu_indices(len(fc_mat), 1)]
+
+
+def as_full_matrix(value) -> np.ndarray:
+    """Full matrix of a packed or sparse matrix or of a legacy full matrix given as nested lists."""
+    if is_packed(value):
+        return unpack_matrix(value)
+    if is_sparse(value):
+        return vec_to_full_matrix(densify_vector(value))
+    return np.asarray(value)
@@ -0,0 +1,76 @@
+"""
+Lightweight per-stage profiling of tasks.
+
+A StageProfiler records the wall time of named stages and the process's peak RSS after each of them. Peak
+RSS is a high-water mark, so the stage after which it grows is the one that raised it. A disabled profiler
+hands out a shared no-op context manager and records nothing, so instrumented code costs a method call per
+stage when profiling is off.
+"""
+import resource
+import sys
+import time
+from contextlib import nullcontext
+
+_NO_STAGE = nullcontext()
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process (ru_maxrss is in KiB on Linux and in bytes on macOS)."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class StageProfiler:
+    def __init__(self, enabled: bool = True):
+        """
+        Args:
+            enabled: record stages; when False stage() is a no-op and record() returns None.
+        """
+        self.enabled = enabled
+        self.stages = []
+        self._start = time.perf_counter() if enabled else None
+
+    def stage(self, name: str):
+        """Context manager timing the enclosed block as stage name."""
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def add(self, name: str, seconds: float):
+        """Records a stage that was timed elsewhere."""
+        if self.enabled:
+            self.stages.append({"name": name, "seconds": seconds, "peak_rss_bytes": peak_rss_bytes()})
+
+    def record(self):
+        """The stages so far, the time since the profiler was created and the peak RSS, or None if disabled."""
+        if not self.enabled:
+            return None
+        return {
+            "stages": list(self.stages),
+            "total_seconds": time.perf_counter() - self._start,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: StageProfiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage_seconds(record: dict) -> dict:
+    """Seconds per stage name of a record, summing stages that occur more than once."""
+    seconds = {}
+    for stage in record.get("stages", []):
+        seconds[stage["name"]] = seconds.get(stage["name"], 0.0) + stage["seconds"]
+    return seconds
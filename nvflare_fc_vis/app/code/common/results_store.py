@@ -0,0 +1,154 @@
+"""
+Append-only store of result matrices.
+
+A store is a directory with two files:
+  matrices.bin  the packed upper triangles (see common.packing) of all results, back to back, each starting
+                at a multiple of ALIGNMENT bytes
+  index.jsonl   one JSON line per result: job_id, site, round, name, variant, parameters and the offset,
+                dtype and number of nodes of its triangle in matrices.bin
+
+Sparse results (common.packing.sparsify_vector) are stored as they are, their indices followed by their
+values at values_offset; load expands them to the full edge vector, load_sparse does not.
+
+Appends take an exclusive lock on the store, so several sites or jobs can share one. Readers do not lock:
+the data is written before its index line, so every complete index line points at complete data. Matrices
+are loaded as read-only memory maps, so querying hundreds of runs only reads the index.
+"""
+import fcntl
+import json
+import os
+import time
+
+import numpy as np
+
+from .packing import (
+    INDEX_DTYPE, SPARSE_FORMAT, as_edge_vector, is_packed, is_sparse, num_edges_from_nodes, num_nodes_from_edges,
+    unpack_sparse, unpack_vector, vec_to_full_matrix,
+)
+
+DATA_FILENAME = "matrices.bin"
+INDEX_FILENAME = "index.jsonl"
+LOCK_FILENAME = "store.lock"
+ALIGNMENT = 64
+
+
+class ResultsStore:
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.data_path = os.path.join(store_dir, DATA_FILENAME)
+        self.index_path = os.path.join(store_dir, INDEX_FILENAME)
+        self.lock_path = os.path.join(store_dir, LOCK_FILENAME)
+
+    def append(self, dp_fc_mean, job_id: str = None, site: str = None, current_round: int = None,
+               name: str = None, variant: int = None, parameters: dict = None) -> dict:
+        """
+        Stores a result matrix, packed, sparse or given as a full matrix (legacy nested lists), and returns
+        its index record. Packed and sparse matrices are stored in their own dtype.
+        """
+        sparse_fields = {}
+        if is_sparse(dp_fc_mean):
+            indices, fc_vec = unpack_sparse(dp_fc_mean)
+            num_nodes = dp_fc_mean["num_nodes"]
+            index_data = indices.tobytes()
+            # the values start at the next aligned offset after the indices
+            padding = -len(index_data) % ALIGNMENT
+            data = index_data + b"\0" * padding + fc_vec.tobytes()
+            sparse_fields = {"format": SPARSE_FORMAT, "num_values": len(fc_vec)}
+        else:
+            fc_vec = unpack_vector(dp_fc_mean) if is_packed(dp_fc_mean) else \
+                np.asarray(as_edge_vector(dp_fc_mean), dtype=np.float64)
+            num_nodes = num_nodes_from_edges(len(fc_vec))
+            data = fc_vec.tobytes()
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.data_path, "ab") as data_file:
+                    end = data_file.seek(0, os.SEEK_END)
+                    offset = -(-end // ALIGNMENT) * ALIGNMENT
+                    data_file.write(b"\0" * (offset - end))
+                    data_file.write(data)
+                record = {
+                    "job_id": job_id,
+                    "site": site,
+                    "round": current_round,
+                    "name": name,
+                    "variant": variant,
+                    "parameters": parameters or {},
+                    "offset": offset,
+                    "dtype": fc_vec.dtype.name,
+                    "num_nodes": num_nodes,
+                    "created": time.time(),
+                }
+                if sparse_fields:
+                    values_offset = offset + len(data) - fc_vec.nbytes
+                    record.update(sparse_fields, values_offset=values_offset)
+                with open(self.index_path, "a") as index_file:
+                    index_file.write(json.dumps(record, default=to_json) + "\n")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return record
+
+    def records(self) -> list:
+        """All index records, in the order they were appended."""
+        if not os.path.exists(self.index_path):
+            return []
+        records = []
+        with open(self.index_path, "r") as index_file:
+            for line in index_file:
+                # a line that is still being written is skipped
+                if line.endswith("\n"):
+                    records.append(json.loads(line))
+        return records
+
+    def query(self, parameters: dict = None, **fields) -> list:
+        """
+        Records whose fields equal the given ones (e.g. site="site1", name="global_average") and whose
+        parameters contain the given parameters.
+        """
+        parameters = parameters or {}
+        return [
+            record for record in self.records()
+            if all(record.get(key) == value for key, value in fields.items())
+            and all(record["parameters"].get(key) == value for key, value in parameters.items())
+        ]
+
+    def load(self, record: dict, fill=0.0) -> np.ndarray:
+        """
+        Edge vector of a record, as a read-only memory map of the store. Sparse records are expanded to a new
+        array with fill for the edges that were not stored.
+        """
+        if record.get("format") == SPARSE_FORMAT:
+            indices, values = self.load_sparse(record)
+            fc_vec = np.full(num_edges_from_nodes(record["num_nodes"]), fill, dtype=values.dtype)
+            fc_vec[indices] = values
+            return fc_vec
+        return np.memmap(self.data_path, dtype=record["dtype"], mode="r", offset=record["offset"],
+                         shape=(num_edges_from_nodes(record["num_nodes"]),))
+
+    def load_sparse(self, record: dict):
+        """(indices, values) of a sparse record, as read-only memory maps of the store."""
+        num_values = record["num_values"]
+        if num_values == 0:
+            return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=record["dtype"])
+        indices = np.memmap(self.data_path, dtype=INDEX_DTYPE, mode="r", offset=record["offset"], shape=(num_values,))
+        values = np.memmap(self.data_path, dtype=record["dtype"], mode="r", offset=record["values_offset"],
+                           shape=(num_values,))
+        return indices, values
+
+    def load_matrix(self, record: dict, diagonal=1.0) -> np.ndarray:
+        """Full symmetric matrix of a record."""
+        return vec_to_full_matrix(self.load(record), diagonal)
+
+    def export_json(self, record: dict, file_path: str):
+        """Writes a record as JSON with its full matrix, in the format of the former result files."""
+        with open(file_path, "w") as file:
+            json.dump({**record["parameters"], "dp_fc_mean": self.load_matrix(record).tolist()}, file)
+
+
+def to_json(value):
+    """JSON fallback for numpy scalars in parameters."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
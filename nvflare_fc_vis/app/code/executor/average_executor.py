@@ -1,18 +1,80 @@
+from nvflare.apis.event_type import EventType
 from nvflare.apis.executor import Executor
 from nvflare.apis.fl_constant import FLContextKey
 from nvflare.apis.fl_context import FLContext
 from nvflare.apis.shareable import Shareable
 from nvflare.apis.signal import Signal
 
-from .local_average import get_local_average_and_count
+from common.constants import APPLIED_PARAMETERS_HEADER, CURRENT_ROUND_HEADER, GLOBAL_AVERAGE_ACK_HEADER, PERF_HEADER
+from common.packing import as_full_matrix
+from common.profiling import StageProfiler
+from common.results_store import ResultsStore
+from .local_average import get_local_average_and_count, sparsify_result
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
-import numpy as np
-import matplotlib.pyplot as plt
-from nilearn import plotting
+
+# plot policy -> dpi of the rendered png (None disables plotting)
+PLOT_DPI = {"none": None, "preview": 72, "full": 300}
 
 
 class AverageExecutor(Executor):
+    def __init__(self, plot_mode: str = "full", plot_in_background: bool = True, use_stats_cache: bool = False,
+                 profile: bool = False, export_json: bool = False, sparse_top_k: int = None,
+                 sparse_threshold: float = None, allow_parameter_overrides: bool = False):
+        """
+        Args:
+            plot_mode: "none", "preview" (low-res) or "full" (dpi=300) rendering of result matrices.
+            plot_in_background: render on a worker thread so the task result is returned without waiting
+                for the plot; pending plots are finished before the run ends.
+            use_stats_cache: reuse the site's cached clipped mean and count when its data is unchanged
+                (see executor.stats_cache); DP noise is still drawn fresh on every run.
+            profile: attach a stage timing and peak RSS record (common.profiling) to every task result.
+            export_json: besides the results store (common.results_store), write every result to
+                <name>.json with its full matrix, as the results directory used to hold.
+            sparse_top_k: send only the top_k strongest edges of the local result (sparse transport for
+                bandwidth-limited sites); the site keeps its full result. None sends every edge.
+            sparse_threshold: send only the edges with an absolute value of at least this; combined with
+                sparse_top_k, the top_k strongest of those. The global average is sparse if any site is.
+            allow_parameter_overrides: accept computation_parameters sent by the job (e.g. a sweep point).
+                They may only tighten the site's own epsilon, delta and clipping bound, and all their releases
+                together must stay within the site's privacy budget; other ones fail the task. When disabled they are ignored. Either way the result reports the parameters applied,
+                and AverageWorkflow fails a job whose parameters a site did not apply.
+        """
+        super().__init__()
+        if plot_mode not in PLOT_DPI:
+            raise ValueError(f"plot_mode must be one of {list(PLOT_DPI)}, got {plot_mode!r}")
+        if sparse_top_k is not None and sparse_top_k < 1:
+            raise ValueError(f"sparse_top_k must be None or at least 1, got {sparse_top_k!r}")
+        if sparse_threshold is not None and sparse_threshold < 0:
+            raise ValueError(f"sparse_threshold must be None or non-negative, got {sparse_threshold!r}")
+        self.plot_mode = plot_mode
+        self.plot_in_background = plot_in_background
+        self.use_stats_cache = use_stats_cache
+        self.profile = profile
+        self.export_json = export_json
+        self.sparse_top_k = sparse_top_k
+        self.sparse_threshold = sparse_threshold
+        self.allow_parameter_overrides = allow_parameter_overrides
+        self._plot_pool = None
+
+    def handle_event(self, event_type: str, fl_ctx: FLContext):
+        if event_type == EventType.END_RUN:
+            self.wait_for_plots()
+
+    def wait_for_plots(self):
+        if self._plot_pool is not None:
+            self._plot_pool.shutdown(wait=True)
+            self._plot_pool = None
+
+    def get_plot_pool(self):
+        if not self.plot_in_background:
+            return None
+        # one worker renders the plots in order; plot_matrix_to_file does not use pyplot, so any thread will do
+        if self._plot_pool is None:
+            self._plot_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fc_plot")
+        return self._plot_pool
+
     def execute(
         self,
         task_name: str,
@@ -21,34 +83,131 @@ class AverageExecutor(Executor):
         abort_signal: Signal,
     ) -> Shareable:
 
+        profiler = StageProfiler(enabled=self.profile)
+
         if task_name == "get_local_average_and_count":
+            # the previous round's global average, when the workflow fuses it into this task
+            previous_global_average = shareable.get("previous_global_average", None)
+            if previous_global_average:
+                save_results_to_file(previous_global_average["global_average"], "global_average", fl_ctx,
+                                     self.plot_mode, self.get_plot_pool(), profiler, self.export_json,
+                                     previous_global_average["round"])
+
             data_dir_path = get_data_dir_path(fl_ctx)
-            #computation_parameters = fl_ctx.get_peer_context().get_prop("COMPUTATION_PARAMETERS")
-            local_result = get_local_average_and_count(data_dir_path)
+            # parameters set by the job (e.g. one point of a sweep) override the site's own, if the site allows it
+            computation_parameters = shareable.get("computation_parameters", None)
+            if computation_parameters and not self.allow_parameter_overrides:
+                self.log_warning(fl_ctx, "Ignoring the job's computation_parameters, allow_parameter_overrides is off.")
+                computation_parameters = None
+            local_result = get_local_average_and_count(
+                data_dir_path, self.use_stats_cache, profiler, computation_parameters,
+                fl_ctx.get_prop(FLContextKey.CLIENT_NAME), shareable.get_header(CURRENT_ROUND_HEADER),
+                fl_ctx.get_job_id(),
+            )
+
+            # save local info to the results store
+            save_results_to_file(local_result, "local_result", fl_ctx, self.plot_mode, self.get_plot_pool(),
+                                 profiler, self.export_json, shareable.get_header(CURRENT_ROUND_HEADER))
 
-            # save local info to local results file
-            save_results_to_file(local_result, "local_result", fl_ctx)
+            if self.sparse_top_k is not None or self.sparse_threshold is not None:
+                with profiler.stage("sparsify"):
+                    local_result = sparsify_result(local_result, self.sparse_top_k, self.sparse_threshold)
 
             outgoing_shareable = Shareable()
             outgoing_shareable["result"] = local_result
+            # echo the round so the server can attribute a result that arrives after the round closed
+            outgoing_shareable.set_header(CURRENT_ROUND_HEADER, shareable.get_header(CURRENT_ROUND_HEADER))
+            outgoing_shareable.set_header(APPLIED_PARAMETERS_HEADER, computation_parameters)
+            if previous_global_average:
+                outgoing_shareable.set_header(GLOBAL_AVERAGE_ACK_HEADER, previous_global_average["round"])
+            if self.profile:
+                outgoing_shareable.set_header(PERF_HEADER, profiler.record())
             return outgoing_shareable
 
         if task_name == "accept_global_average":
-            # save global average to local results file
+            # save global average to the results store
             result = shareable.get("global_average", {})
-            save_results_to_file(result, "global_average", fl_ctx)
-            return Shareable()
+            save_results_to_file(result, "global_average", fl_ctx, self.plot_mode, self.get_plot_pool(),
+                                 profiler, self.export_json, shareable.get_header(CURRENT_ROUND_HEADER))
+            outgoing_shareable = Shareable()
+            if self.profile:
+                outgoing_shareable.set_header(PERF_HEADER, profiler.record())
+            return outgoing_shareable
 
 
-def save_results_to_file(results: dict, file_name: str, fl_ctx: FLContext):
+def save_results_to_file(results: dict, file_name: str, fl_ctx: FLContext, plot_mode: str = "full",
+                         plot_pool: ThreadPoolExecutor = None, profiler: StageProfiler = None,
+                         export_json: bool = False, current_round: int = None):
+    """
+    Appends the result matrices to the results store under file_name, with the job, site, round and
+    parameters, and renders dp_fc_mean to a png according to plot_mode. With export_json the result is
+    also written to file_name.json. When plot_pool is given the rendering is queued on it and this returns
+    as soon as the result is stored; the profiler then only sees the time to queue the plot.
+    Multi-configuration results get one store record and one png per variant, file_name_<i>.png.
+    """
+    if not results:
+        return  # nothing was aggregated
+    profiler = profiler or StageProfiler(enabled=False)
     results_dir = get_results_dir_path(fl_ctx)
     print(f"\nSaving results to: {results_dir}\n")
-    with open(os.path.join(results_dir, file_name+".json"), "w") as f:
-        json.dump(results, f)
-    
-    fig = plt.figure(figsize=(5, 3))
-    plotting.plot_matrix(np.array(results["dp_fc_mean"]), figure=fig, vmax=1, vmin=-1)
-    fig.savefig(os.path.join(results_dir, file_name+".png"), transparent=True, bbox_inches='tight', dpi=300)
+    variants = results["variants"] if "variants" in results else [results]
+    summary = {key: value for key, value in results.items() if key not in ("dp_fc_mean", "variants")}
+
+    with profiler.stage("write_results"):
+        store = ResultsStore(get_results_store_dir(fl_ctx))
+        for i, variant in enumerate(variants):
+            store.append(
+                variant["dp_fc_mean"], job_id=fl_ctx.get_job_id(), site=fl_ctx.get_prop(FLContextKey.CLIENT_NAME),
+                current_round=current_round, name=file_name, variant=i if "variants" in results else None,
+                parameters={**summary, **{key: value for key, value in variant.items() if key != "dp_fc_mean"}},
+            )
+
+    dpi = PLOT_DPI[plot_mode]
+    if dpi is None and not export_json:
+        return
+
+    # the packed wire format is only expanded to the full matrix for the JSON export and the plots
+    dp_fc_means = [as_full_matrix(variant["dp_fc_mean"]) for variant in variants]
+
+    if export_json:
+        with profiler.stage("export_json"):
+            if "variants" in results:
+                json_variants = [
+                    {**variant, "dp_fc_mean": dp_fc_mean.tolist()}
+                    for variant, dp_fc_mean in zip(variants, dp_fc_means)
+                ]
+                json_results = {**results, "variants": json_variants}
+            else:
+                json_results = {**results, "dp_fc_mean": dp_fc_means[0].tolist()}
+            with open(os.path.join(results_dir, file_name+".json"), "w") as f:
+                json.dump(json_results, f)
+
+    if dpi is None:
+        return
+    plot_names = [f"{file_name}_{i}" for i in range(len(variants))] if "variants" in results else [file_name]
+
+    # matplotlib and nilearn are only imported once a plot is actually produced
+    from .visualization import plot_matrix_to_file
+
+    for dp_fc_mean, plot_name in zip(dp_fc_means, plot_names):
+        plot_file_path = os.path.join(results_dir, plot_name+".png")
+        if plot_pool is None:
+            with profiler.stage("plot"):
+                plot_matrix_to_file(dp_fc_mean, plot_file_path, dpi)
+        else:
+            with profiler.stage("plot_queue"):
+                future = plot_pool.submit(plot_matrix_to_file, dp_fc_mean, plot_file_path, dpi)
+                future.add_done_callback(report_plot_error)
+
+
+def report_plot_error(future):
+    if future.exception() is not None:
+        print(f"\nPlot rendering failed: {future.exception()}\n")
+
+
+def get_results_store_dir(fl_ctx: FLContext) -> str:
+    """RESULTS_STORE_DIR if set (e.g. one store shared by many jobs), else results_store in the results directory."""
+    return os.getenv("RESULTS_STORE_DIR") or os.path.join(get_results_dir_path(fl_ctx), "results_store")
 
 
 def get_results_dir_path(fl_ctx: FLContext) -> str:
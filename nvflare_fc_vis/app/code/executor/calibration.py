@@ -0,0 +1,227 @@
+import json
+import os
+import tempfile
+from functools import lru_cache
+from math import exp, sqrt
+
+import numpy as np
+from scipy.special import erf
+
+# number of (epsilon, delta) calibrations kept in memory per process
+CALIBRATION_CACHE_SIZE = 1024
+# optional JSON file of precomputed calibrations shared across runs, keyed by "epsilon,delta,tol"
+CALIBRATION_TABLE_ENV = "DP_CALIBRATION_TABLE"
+
+
+def calibrate_analytic_gaussian(epsilon, delta, GS, tol=1.e-12):
+
+    """
+    Memoized calibrateAnalyticGaussianMechanism.
+
+    The noise scale is linear in the sensitivity (sigma = alpha(epsilon, delta) * GS / sqrt(2 epsilon)),
+    so only the unit-sensitivity calibration is searched for and cached; GS is applied afterwards.
+    """
+
+    return unit_sigma(float(epsilon), float(delta), float(tol)) * GS
+
+
+@lru_cache(maxsize=CALIBRATION_CACHE_SIZE)
+def unit_sigma(epsilon, delta, tol=1.e-12):
+
+    """Noise standard deviation for unit sensitivity, read from the on-disk table when one is configured."""
+
+    table_path = os.getenv(CALIBRATION_TABLE_ENV)
+    key = table_key(epsilon, delta, tol)
+
+    if table_path:
+        table = load_calibration_table(table_path)
+        if key in table:
+            return table[key]
+
+    sigma = calibrateAnalyticGaussianMechanism(epsilon, delta, 1.0, tol)
+
+    if table_path:
+        update_calibration_table(table_path, {key: sigma})
+
+    return sigma
+
+
+def table_key(epsilon, delta, tol=1.e-12):
+    return f"{float(epsilon)!r},{float(delta)!r},{float(tol)!r}"
+
+
+def load_calibration_table(table_path: str) -> dict:
+    if not os.path.exists(table_path):
+        return {}
+    try:
+        with open(table_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_calibration_table(table_path: str, entries: dict):
+
+    """Merges entries into the table file; the file is replaced atomically so readers never see a partial write."""
+
+    table = load_calibration_table(table_path)
+    table.update(entries)
+    table_dir = os.path.dirname(os.path.abspath(table_path))
+    try:
+        os.makedirs(table_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=table_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(table, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, table_path)
+    except OSError as e:
+        # the table is only a cache, a read-only location must not fail the computation
+        print(f"could not update calibration table {table_path}: {e}")
+
+
+def precompute_calibration_table(table_path: str, epsilons, deltas, tol=1.e-12):
+
+    """Calibrates every (epsilon, delta) pair of the grid in one vectorized call and stores them in the table."""
+
+    epsilon_grid, delta_grid = np.meshgrid(np.asarray(epsilons, dtype=float), np.asarray(deltas, dtype=float))
+    sigmas = calibrate_analytic_gaussian_grid(epsilon_grid, delta_grid, 1.0, tol)
+    entries = {
+        table_key(e, d, tol): float(s)
+        for e, d, s in zip(epsilon_grid.ravel(), delta_grid.ravel(), sigmas.ravel())
+    }
+    update_calibration_table(table_path, entries)
+
+    return entries
+
+
+def calibrate_analytic_gaussian_grid(epsilons, deltas, GS=1.0, tol=1.e-12, max_iter=200):
+
+    """
+    Vectorized calibrateAnalyticGaussianMechanism: runs the doubling trick and the binary search for all
+    broadcast (epsilon, delta) pairs at once with array erf calls. Elements that have converged are frozen
+    while the others continue.
+
+    Output:
+      sigma: array with the broadcast shape of epsilons, deltas and GS
+    """
+
+    epsilon, delta = np.broadcast_arrays(np.asarray(epsilons, dtype=float), np.asarray(deltas, dtype=float))
+    shape = epsilon.shape
+    epsilon = epsilon.ravel()
+    delta = delta.ravel()
+
+    def Phi(t):
+        return 0.5*(1.0 + erf(t/np.sqrt(2.0)))
+
+    def caseA(s):
+        return Phi(np.sqrt(epsilon*s)) - np.exp(epsilon)*Phi(-np.sqrt(epsilon*(s+2.0)))
+
+    def caseB(s):
+        return Phi(-np.sqrt(epsilon*s)) - np.exp(epsilon)*Phi(-np.sqrt(epsilon*(s+2.0)))
+
+    delta_thr = caseA(np.zeros_like(epsilon))
+    use_caseA = delta > delta_thr
+
+    def function_s_to_delta(s):
+        return np.where(use_caseA, caseA(s), caseB(s))
+
+    # doubling trick
+    s_inf = np.zeros_like(epsilon)
+    s_sup = np.ones_like(epsilon)
+    s_to_delta = function_s_to_delta(s_sup)
+    done = np.where(use_caseA, s_to_delta >= delta, s_to_delta <= delta)
+    while not done.all():
+        s_inf = np.where(done, s_inf, s_sup)
+        s_sup = np.where(done, s_sup, 2.0*s_sup)
+        s_to_delta = function_s_to_delta(s_sup)
+        done = np.where(use_caseA, s_to_delta >= delta, s_to_delta <= delta)
+
+    # binary search
+    s_mid = s_inf + (s_sup-s_inf)/2.0
+    s_to_delta = function_s_to_delta(s_mid)
+    converged = np.abs(s_to_delta - delta) <= tol
+    for _ in range(max_iter):
+        if converged.all():
+            break
+        go_left = np.where(use_caseA, s_to_delta > delta, s_to_delta < delta)
+        s_sup = np.where(~converged & go_left, s_mid, s_sup)
+        s_inf = np.where(~converged & ~go_left, s_mid, s_inf)
+        s_mid = np.where(converged, s_mid, s_inf + (s_sup-s_inf)/2.0)
+        s_to_delta = function_s_to_delta(s_mid)
+        converged = np.abs(s_to_delta - delta) <= tol
+
+    alpha = np.where(use_caseA, np.sqrt(1.0 + s_mid/2.0) - np.sqrt(s_mid/2.0),
+                     np.sqrt(1.0 + s_mid/2.0) + np.sqrt(s_mid/2.0))
+    alpha = np.where(delta == delta_thr, 1.0, alpha)
+
+    sigma = alpha.reshape(shape)*GS/np.sqrt(2.0*epsilon.reshape(shape))
+
+    return sigma
+
+
+def calibrateAnalyticGaussianMechanism(epsilon, delta, GS, tol=1.e-12):
+
+    """
+    Calibrate a Gaussian perturbation for differential privacy using the analytic Gaussian mechanism of [Balle and Wang, ICML'18]
+
+    Input:
+      epsilon: target epsilon (epsilon > 0)
+      delta: target delta (0 < delta < 1)
+      GS: upper bound on L2 global sensitivity (GS >= 0)
+      tol: error tolerance for binary search (tol > 0)
+
+    Output:
+      sigma: standard deviation of Gaussian noise needed to achieve (epsilon,delta)-DP under global sensitivity GS
+    """
+
+    def Phi(t):
+        return 0.5*(1.0 + erf(float(t)/sqrt(2.0)))
+
+    def caseA(epsilon,s):
+        return Phi(sqrt(epsilon*s)) - exp(epsilon)*Phi(-sqrt(epsilon*(s+2.0)))
+
+    def caseB(epsilon,s):
+        return Phi(-sqrt(epsilon*s)) - exp(epsilon)*Phi(-sqrt(epsilon*(s+2.0)))
+
+    def doubling_trick(predicate_stop, s_inf, s_sup):
+        while(not predicate_stop(s_sup)):
+            s_inf = s_sup
+            s_sup = 2.0*s_inf
+        return s_inf, s_sup
+
+    def binary_search(predicate_stop, predicate_left, s_inf, s_sup):
+        s_mid = s_inf + (s_sup-s_inf)/2.0
+        while(not predicate_stop(s_mid)):
+            if (predicate_left(s_mid)):
+                s_sup = s_mid
+            else:
+                s_inf = s_mid
+            s_mid = s_inf + (s_sup-s_inf)/2.0
+        return s_mid
+
+    delta_thr = caseA(epsilon, 0.0)
+
+    if (delta == delta_thr):
+        alpha = 1.0
+
+    else:
+        if (delta > delta_thr):
+            predicate_stop_DT = lambda s : caseA(epsilon, s) >= delta
+            function_s_to_delta = lambda s : caseA(epsilon, s)
+            predicate_left_BS = lambda s : function_s_to_delta(s) > delta
+            function_s_to_alpha = lambda s : sqrt(1.0 + s/2.0) - sqrt(s/2.0)
+
+        else:
+            predicate_stop_DT = lambda s : caseB(epsilon, s) <= delta
+            function_s_to_delta = lambda s : caseB(epsilon, s)
+            predicate_left_BS = lambda s : function_s_to_delta(s) < delta
+            function_s_to_alpha = lambda s : sqrt(1.0 + s/2.0) + sqrt(s/2.0)
+
+        predicate_stop_BS = lambda s : abs(function_s_to_delta(s) - delta) <= tol
+
+        s_inf, s_sup = doubling_trick(predicate_stop_DT, 0.0, 1.0)
+        s_final = binary_search(predicate_stop_BS, predicate_left_BS, s_inf, s_sup)
+        alpha = function_s_to_alpha(s_final)
+
+    sigma = alpha*GS/sqrt(2.0*epsilon)
+
+    return sigma
@@ -1,42 +1,348 @@
 import json
 import os
 import numpy as np
-from math import exp, sqrt
-from scipy.special import erf
-
-
-def get_local_average_and_count(data_dir_path: str):
-    data_file_filepath = os.path.join(data_dir_path, "data.json")
+from common.packing import (
+    DEFAULT_WIRE_DTYPE, num_nodes_from_edges, pack_matrix, sparsify_vector, unpack_vector, vec_to_full_matrix,
+)
+from common.profiling import StageProfiler
+from .noise import noise_seed_sequence, add_clipped_noise
+from .calibration import calibrate_analytic_gaussian, calibrate_analytic_gaussian_grid
+from .stats_cache import stats_cache_dir, stats_cache_key, load_stats, store_stats
+
+
+DATA_JSON_FILENAME = "data.json"
+HEADER_FILENAME = "header.json"
+NPY_FILENAME = "fc_vecs.npy"
+RAW_FILENAME = "fc_vecs.bin"
+# number of subjects clipped and summed at a time by streaming_clipped_mean
+DEFAULT_CHUNK_SIZE = 256
+# low-rank post-processing uses the iterative top-k solver when k/n is at most this fraction
+# and the matrix has at least EIGSH_MIN_NODES nodes; otherwise a dense symmetric eigensolver
+EIGSH_MAX_FRACTION = 0.1
+EIGSH_MIN_NODES = 200
+# "precision" of the computation; means and sums are always accumulated in float64
+PRECISIONS = ("float64", "float32")
+
+
+def get_local_average_and_count(data_dir_path: str, use_stats_cache: bool = False, profiler: StageProfiler = None,
+                                overrides: dict = None, site_name: str = None, current_round: int = None,
+                                job_id: str = None):
+    """
+    DP mean FC matrix of the site. overrides (e.g. the computation parameters of a sweep job) take
+    precedence over the parameters in the site's data.json or header.json. If the parameters list
+    "configurations", one matrix per configuration is returned (see get_local_variants).
 
-    print(f"\nloading data from: {data_file_filepath} \n")
+    The noise is drawn from a stream of its own for (job_id, site_name, current_round) and the privacy
+    settings, reproducible if the site's parameters set "noise_seed" (see executor.noise). With "precision": "float32" clipping, noise, the
+    matrix and its eigendecomposition are computed in float32.
+    """
+    profiler = profiler or StageProfiler(enabled=False)
+    # the seed reveals the noise, it is only taken from the site's own parameters
+    overrides = {key: value for key, value in (overrides or {}).items() if key != "noise_seed"}
+    data, fc_mean_vec, num_subs = get_site_statistics(data_dir_path, use_stats_cache, profiler, overrides)
+    fc_mean_vec = fc_mean_vec.astype(compute_dtype(data), copy=False)
+    release = {"privacy_settings": privacy_settings(data), "pre_processing_bound": clipping_bound(data)}
+    seed_sequence = noise_seed_sequence(data.get("noise_seed"), site_name, current_round, job_id, release)
+    noise_threads = data.get("noise_threads")
+    if "configurations" in data:
+        return get_local_variants(data, fc_mean_vec, num_subs, profiler, seed_sequence, noise_threads)
 
-    with open(data_file_filepath, "r") as file:
-        data = json.load(file)
-        
-    fc_vecs = data["fc_vecs"]
-    num_subs = len(fc_vecs)
     # differentially private parameters
     epsilon = data["epsilon"]
     delta = data["delta"]
     # pre-processing: clipping bound (default value is 1)
-    if "pre_processing_bound" in data:
-        bound = min(abs(data["pre_processing_bound"]), 1)
-    else:
-        bound = 1
+    bound = clipping_bound(data)
     # post-processing: SVD components (default value is num_nodes)
     if "post_processing_components" in data:
         post_para_svd = data["post_processing_components"]
     else:
-        post_para_svd = int(np.roots([1, -1, -2*len(fc_vecs[0])])[0])
-        
-    fc_vecs_clip = data_clip(fc_vecs, bound)
-    fc_mean_mat_dp = dp_fc_mean(fc_vecs_clip, bound, epsilon, delta)
-    fc_mean_mat_dp_svd = postprocess(fc_mean_mat_dp, bound, post_para_svd).tolist()
+        post_para_svd = num_nodes_from_edges(len(fc_mean_vec))
+    # wire format of the result: packed upper triangle, float32 unless "wire_dtype" says otherwise
+    wire_dtype = data.get("wire_dtype", DEFAULT_WIRE_DTYPE)
+
+    with profiler.stage("calibration"):
+        sigma2 = noise_variance(len(fc_mean_vec), num_subs, bound, epsilon, delta)
+    with profiler.stage("noise"):
+        fc_mean_mat_dp = noisy_mat(fc_mean_vec, bound, sigma2, seed_sequence, noise_threads)
+    with profiler.stage("postprocess"):
+        fc_mean_mat_dp_svd = postprocess(fc_mean_mat_dp, bound, post_para_svd)
+    with profiler.stage("pack"):
+        fc_mean_mat_dp_svd = pack_matrix(fc_mean_mat_dp_svd, wire_dtype)
 
     return {"dp_fc_mean": fc_mean_mat_dp_svd, "count": num_subs, "epsilon": epsilon, "delta": delta, 
             "pre_processing_bound": bound, "post_processing_components": post_para_svd}
 
 
+def get_local_variants(data: dict, fc_mean_vec, num_subs: int, profiler: StageProfiler = None,
+                       seed_sequence=None, noise_threads: int = None):
+    """
+    DP mean FC matrices for every entry of data["configurations"], each a dict with epsilon, delta and
+    post_processing_components (missing keys default to the top-level parameters). All of them share the
+    clipped mean and the clipping bound. The noise scales are calibrated in one vectorized call and the
+    noise for all (epsilon, delta) pairs is drawn at once. Configurations that differ only in
+    post_processing_components share one noisy matrix and its eigendecomposition.
+
+    Output:
+      {"count", "pre_processing_bound", "variants": [{"dp_fc_mean", "epsilon", "delta",
+      "post_processing_components"}, ...]} with the variants in the order of the configurations
+    """
+    profiler = profiler or StageProfiler(enabled=False)
+    num_edges = len(fc_mean_vec)
+    bound = clipping_bound(data)
+    wire_dtype = data.get("wire_dtype", DEFAULT_WIRE_DTYPE)
+    defaults = {
+        key: data[key] for key in ("epsilon", "delta", "post_processing_components") if key in data
+    }
+    defaults.setdefault("post_processing_components", num_nodes_from_edges(num_edges))
+    configurations = [{**defaults, **configuration} for configuration in data["configurations"]]
+
+    # one noisy matrix per distinct (epsilon, delta), in order of first appearance
+    privacy_pairs = list(dict.fromkeys((conf["epsilon"], conf["delta"]) for conf in configurations))
+
+    with profiler.stage("calibration"):
+        sensitivity = np.sqrt(bound**2*num_edges)/num_subs
+        epsilons, deltas = zip(*privacy_pairs)
+        sigmas = calibrate_analytic_gaussian_grid(epsilons, deltas, sensitivity)
+    with profiler.stage("noise"):
+        fc_mean_vecs_dp = np.empty((len(privacy_pairs), num_edges), dtype=fc_mean_vec.dtype)
+        add_clipped_noise(fc_mean_vec, bound, sigmas, seed_sequence, fc_mean_vecs_dp, noise_threads)
+
+    variants = [None] * len(configurations)
+    with profiler.stage("postprocess"):
+        for fc_mean_vec_dp, privacy_pair in zip(fc_mean_vecs_dp, privacy_pairs):
+            indices = [i for i, conf in enumerate(configurations) if (conf["epsilon"], conf["delta"]) == privacy_pair]
+            components = [configurations[i]["post_processing_components"] for i in indices]
+            low_rank_mats = low_rank_approximations(vec_to_mat(fc_mean_vec_dp), components)
+            for i, low_rank_mat in zip(indices, low_rank_mats):
+                variants[i] = {
+                    "dp_fc_mean": pack_matrix(clip_with_unit_diagonal(low_rank_mat, bound), wire_dtype),
+                    "epsilon": configurations[i]["epsilon"],
+                    "delta": configurations[i]["delta"],
+                    "post_processing_components": configurations[i]["post_processing_components"],
+                }
+
+    return {"count": num_subs, "pre_processing_bound": bound, "variants": variants}
+
+
+def sparsify_result(result: dict, top_k: int = None, threshold: float = None) -> dict:
+    """
+    Copy of a result of get_local_average_and_count with every dp_fc_mean reduced to its edges with an
+    absolute value of at least threshold, and of those the top_k strongest (see common.packing.sparsify_vector).
+    """
+    def sparsify(variant):
+        return {**variant, "dp_fc_mean": sparsify_vector(unpack_vector(variant["dp_fc_mean"]), top_k, threshold)}
+
+    if "variants" in result:
+        return {**result, "variants": [sparsify(variant) for variant in result["variants"]]}
+    return sparsify(result)
+
+
+def get_site_statistics(data_dir_path: str, use_stats_cache: bool = False, profiler: StageProfiler = None,
+                        overrides: dict = None):
+    """
+    Pre-noise statistics of the site: the parameters, the clipped mean of the FC vectors and the number
+    of subjects. With use_stats_cache they are looked up in (and stored to) the statistics cache beside
+    the data directory, so an unchanged cohort is not read again. Binary inputs are memory mapped, so
+    their reads show up in the profiler's "clip_mean" stage rather than in "load".
+
+    For binary inputs the header is always read fresh, so changing epsilon/delta/components there keeps
+    the cache valid; for data.json the parameters are part of the hashed file. An overridden clipping
+    bound is part of the cache key. Overrides that loosen the site's own privacy settings or exceed its
+    privacy budget raise ValueError (see check_overrides).
+    """
+
+    profiler = profiler or StageProfiler(enabled=False)
+    overrides = overrides or {}
+
+    if use_stats_cache:
+        with profiler.stage("stats_cache_lookup"):
+            data_filepath = find_site_data_file(data_dir_path)
+            if data_filepath.endswith(DATA_JSON_FILENAME):
+                header = None
+                header_bound = clipping_bound(overrides) if "pre_processing_bound" in overrides else None
+            else:
+                site_header = load_header(os.path.join(data_dir_path, HEADER_FILENAME))
+                check_overrides(site_header, overrides)
+                header = {**site_header, **overrides}
+                header_bound = clipping_bound(header)
+            cache_dir = stats_cache_dir(data_dir_path)
+            cache_key = stats_cache_key(cache_dir, data_filepath, header_bound)
+
+            cached = load_stats(cache_dir, cache_key)
+        if cached is not None:
+            print(f"\nusing cached statistics for: {data_filepath} \n")
+            cached_data, fc_mean_vec, num_subs = cached
+            if header is None:
+                check_overrides(cached_data, overrides)
+            return header if header is not None else {**cached_data, **overrides}, fc_mean_vec, num_subs
+
+    with profiler.stage("load"):
+        fc_vecs, site_data = load_site_data(data_dir_path)
+    check_overrides(site_data, overrides)
+    data = {**site_data, **overrides}
+    num_subs = len(fc_vecs)
+    chunk_size = int(data.get("chunk_size", DEFAULT_CHUNK_SIZE))
+    with profiler.stage("clip_mean"):
+        fc_mean_vec = streaming_clipped_mean(fc_vecs, clipping_bound(data), chunk_size, compute_dtype(data))
+
+    if use_stats_cache:
+        with profiler.stage("stats_cache_store"):
+            store_stats(cache_dir, cache_key, fc_mean_vec, num_subs, site_data if header is None else None)
+
+    return data, fc_mean_vec, num_subs
+
+
+def check_overrides(site_data: dict, overrides: dict):
+    """
+    Raises ValueError unless overrides keep the site's privacy settings as limits: no epsilon or delta (top
+    level or of any configuration) above the largest the site's own parameters release, no larger
+    clipping bound than the site's, and releases that compose to no more than the site's privacy budget.
+
+    Every distinct (epsilon, delta) of a task is released with independent noise, so averaging many
+    releases each just under the site's epsilon would recover the mean with hardly any noise. Their
+    epsilons and deltas add up (basic composition) and the sums may not exceed the site's "privacy_budget"
+    ({"epsilon", "delta"}), by default the sums of the site's own releases. The budget holds per task, i.e.
+    per round.
+    """
+    if not overrides:
+        return
+    if "privacy_budget" in overrides:
+        raise ValueError("privacy_budget is only taken from the site's own parameters")
+    site_settings = privacy_settings(site_data)
+    if not site_settings:
+        raise ValueError("the site's parameters set no epsilon and delta to limit overrides by")
+    max_epsilon = max(epsilon for epsilon, _ in site_settings)
+    max_delta = max(delta for _, delta in site_settings)
+
+    settings = privacy_settings({**site_data, **overrides})
+    for epsilon, delta in settings:
+        if epsilon > max_epsilon:
+            raise ValueError(f"overridden epsilon {epsilon} exceeds the site's epsilon {max_epsilon}")
+        if delta > max_delta:
+            raise ValueError(f"overridden delta {delta} exceeds the site's delta {max_delta}")
+
+    budget_epsilon, budget_delta = privacy_budget(site_data)
+    # configurations with the same (epsilon, delta) share one noisy release (see get_local_variants)
+    releases = list(dict.fromkeys(settings))
+    total_epsilon = sum(epsilon for epsilon, _ in releases)
+    total_delta = sum(delta for _, delta in releases)
+    if total_epsilon > budget_epsilon or total_delta > budget_delta:
+        raise ValueError(
+            f"overridden settings release {len(releases)} noisy matrices with a total epsilon {total_epsilon} "
+            f"and delta {total_delta}, beyond the site's privacy budget (epsilon {budget_epsilon}, "
+            f"delta {budget_delta})"
+        )
+    if clipping_bound({**site_data, **overrides}) > clipping_bound(site_data):
+        raise ValueError(
+            f"overridden pre_processing_bound {overrides['pre_processing_bound']} exceeds the site's "
+            f"{clipping_bound(site_data)}"
+        )
+
+
+def privacy_settings(data: dict) -> list:
+    """(epsilon, delta) of every matrix data releases: the top level, or each of its configurations."""
+    if "configurations" in data:
+        settings = [
+            (configuration.get("epsilon", data.get("epsilon")), configuration.get("delta", data.get("delta")))
+            for configuration in data["configurations"]
+        ]
+    else:
+        settings = [(data.get("epsilon"), data.get("delta"))]
+    return [(epsilon, delta) for epsilon, delta in settings if epsilon is not None and delta is not None]
+
+
+def privacy_budget(data: dict) -> tuple:
+    """
+    (epsilon, delta) the releases of one task may add up to: data's "privacy_budget", else the sums over
+    the distinct (epsilon, delta) data releases itself.
+    """
+    if "privacy_budget" in data:
+        return data["privacy_budget"]["epsilon"], data["privacy_budget"]["delta"]
+    releases = list(dict.fromkeys(privacy_settings(data)))
+    return sum(epsilon for epsilon, _ in releases), sum(delta for _, delta in releases)
+
+
+def compute_dtype(data: dict):
+    precision = data.get("precision", "float64")
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+    return np.dtype(precision)
+
+
+def clipping_bound(data: dict):
+    if "pre_processing_bound" in data:
+        return min(abs(data["pre_processing_bound"]), 1)
+    return 1
+
+
+def find_site_data_file(data_dir_path: str) -> str:
+    """Path of the file holding the subjects, in the order load_site_data checks the formats."""
+    for file_name in (NPY_FILENAME, RAW_FILENAME):
+        file_path = os.path.join(data_dir_path, file_name)
+        if os.path.exists(file_path):
+            return file_path
+    return os.path.join(data_dir_path, DATA_JSON_FILENAME)
+
+
+def load_site_data(data_dir_path: str):
+    """
+    Loads the site's FC vectors and DP parameters, picking the input format from the files found in
+    data_dir_path. Binary inputs are memory mapped so subjects are only paged in when they are read.
+
+    Supported layouts (checked in this order):
+      fc_vecs.npy + header.json: subjects x edges array in .npy format
+      fc_vecs.bin + header.json: raw row-major subjects x edges array, header gives "num_edges" and
+                                 optionally "dtype" (default float32) and "num_subjects"
+      data.json: JSON with "fc_vecs" alongside the parameters
+
+    Output:
+      fc_vecs: subjects x edges array (or list of lists for data.json)
+      data: dict of parameters (epsilon, delta, pre_processing_bound, ...)
+    """
+
+    data_file_filepath = find_site_data_file(data_dir_path)
+    header_filepath = os.path.join(data_dir_path, HEADER_FILENAME)
+    print(f"\nloading data from: {data_file_filepath} \n")
+
+    if data_file_filepath.endswith(NPY_FILENAME):
+        data = load_header(header_filepath)
+        fc_vecs = np.load(data_file_filepath, mmap_mode="r")
+
+    elif data_file_filepath.endswith(RAW_FILENAME):
+        data = load_header(header_filepath)
+        dtype = np.dtype(data.get("dtype", "float32"))
+        num_edges = int(data["num_edges"])
+        row_size = num_edges * dtype.itemsize
+        file_size = os.path.getsize(data_file_filepath)
+        if file_size % row_size != 0:
+            raise ValueError(
+                f"{data_file_filepath} is {file_size} bytes, not a whole number of {num_edges}-edge {dtype.name} rows"
+            )
+        num_subs = file_size // row_size
+        if "num_subjects" in data and int(data["num_subjects"]) != num_subs:
+            raise ValueError(
+                f"{data_file_filepath} holds {num_subs} subjects, header.json says {data['num_subjects']}"
+            )
+        fc_vecs = np.memmap(data_file_filepath, dtype=dtype, mode="r", shape=(num_subs, num_edges))
+
+    else:
+        with open(data_file_filepath, "r") as file:
+            data = json.load(file)
+        fc_vecs = data.pop("fc_vecs")
+
+    if fc_vecs is None or len(fc_vecs) == 0:
+        raise ValueError(f"No subjects found in {data_dir_path}")
+
+    return fc_vecs, data
+
+
+def load_header(header_filepath: str):
+    if not os.path.exists(header_filepath):
+        raise FileNotFoundError(f"Binary site data requires a header file: {header_filepath}")
+    with open(header_filepath, "r") as file:
+        return json.load(file)
+
+
 def data_clip(fc_vecs, bound):
     
     """Pre-processing"""
@@ -47,17 +353,50 @@ def data_clip(fc_vecs, bound):
     return fc_vecs_clip    
 
 
+def streaming_clipped_mean(fc_vecs, bound, chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64):
+
+    """
+    Pre-processing and mean in one pass: equivalent to np.mean(data_clip(fc_vecs, bound), axis=0), but
+    subjects are read chunk_size at a time into a reusable buffer and clipped in place, so peak memory
+    is chunk_size x edges regardless of the number of subjects.
+
+    The chunks are clipped in dtype (float32 halves the buffer and the memory traffic), the sum is always
+    accumulated and returned in float64.
+    """
+
+    num_subs = len(fc_vecs)
+    num_edges = len(fc_vecs[0])
+    chunk_size = max(1, min(chunk_size, num_subs))
+
+    fc_sum = np.zeros(num_edges)
+    chunk_buf = np.empty((chunk_size, num_edges), dtype=dtype)
+
+    for start in range(0, num_subs, chunk_size):
+        stop = min(start + chunk_size, num_subs)
+        chunk = chunk_buf[:stop - start]
+        # assigning copies (and converts) straight into the buffer, no per-chunk temporary
+        chunk[...] = fc_vecs[start:stop]
+        np.clip(chunk, -bound, bound, out=chunk)
+        fc_sum += chunk.sum(axis=0, dtype=np.float64)
+
+    fc_sum /= num_subs
+
+    return fc_sum
+
+
 def dp_fc_mean(fc_vecs, bound, epsilon, delta):
 
-    num_subs, num_nodes, num_edges = para_from_vecs(fc_vecs)
+    num_subs = len(fc_vecs)
+    fc_mean_vec = np.mean(np.array(fc_vecs), axis=0)
+
+    return dp_fc_mean_from_mean(fc_mean_vec, num_subs, bound, epsilon, delta)
 
-    # sensitivity (add/remove) of whole matrix
-    sensitivity = np.sqrt(bound**2*num_edges)/num_subs
-    # use analytic Gaussian mechanism to compute noise variance
-    sigma2 = calibrateAnalyticGaussianMechanism(epsilon, delta, sensitivity)**2
+
+def dp_fc_mean_from_mean(fc_mean_vec, num_subs, bound, epsilon, delta):
+
+    sigma2 = noise_variance(len(fc_mean_vec), num_subs, bound, epsilon, delta)
 
     # add noise to fc matrix
-    fc_mean_vec = np.mean(np.array(fc_vecs), axis=0)
     fc_mean_mat_dp = noisy_mat(fc_mean_vec, bound, sigma2)
 
     return fc_mean_mat_dp
@@ -67,107 +406,123 @@ def para_from_vecs(fc_vecs):
 
     num_subs = len(fc_vecs)
     num_edges = len(fc_vecs[0])
-    num_nodes = int(np.roots([1, -1, -2*num_edges])[0])
+    num_nodes = num_nodes_from_edges(num_edges)
 
     return num_subs, num_nodes, num_edges
 
 
-def calibrateAnalyticGaussianMechanism(epsilon, delta, GS, tol=1.e-12):
+def noise_variance(num_edges, num_subs, bound, epsilon, delta):
 
-    """
-    Calibrate a Gaussian perturbation for differential privacy using the analytic Gaussian mechanism of [Balle and Wang, ICML'18]
+    # sensitivity (add/remove) of whole matrix
+    sensitivity = np.sqrt(bound**2*num_edges)/num_subs
+    # use analytic Gaussian mechanism to compute noise variance
+    return calibrate_analytic_gaussian(epsilon, delta, sensitivity)**2
 
-    Input:
-      epsilon: target epsilon (epsilon > 0)
-      delta: target delta (0 < delta < 1)
-      GS: upper bound on L2 global sensitivity (GS >= 0)
-      tol: error tolerance for binary search (tol > 0)
 
-    Output:
-      sigma: standard deviation of Gaussian noise needed to achieve (epsilon,delta)-DP under global sensitivity GS
-    """
+def noisy_mat(fc_mean_vec, bound, sigma2, seed_sequence=None, noise_threads: int = None):
 
-    def Phi(t):
-        return 0.5*(1.0 + erf(float(t)/sqrt(2.0)))
+    fc_mean_vec_dp = add_clipped_noise(fc_mean_vec, bound, np.sqrt(sigma2), seed_sequence, workers=noise_threads)
+    fc_mean_mat_dp = vec_to_mat(fc_mean_vec_dp)
 
-    def caseA(epsilon,s):
-        return Phi(sqrt(epsilon*s)) - exp(epsilon)*Phi(-sqrt(epsilon*(s+2.0)))
+    return fc_mean_mat_dp
 
-    def caseB(epsilon,s):
-        return Phi(-sqrt(epsilon*s)) - exp(epsilon)*Phi(-sqrt(epsilon*(s+2.0)))
 
-    def doubling_trick(predicate_stop, s_inf, s_sup):
-        while(not predicate_stop(s_sup)):
-            s_inf = s_sup
-            s_sup = 2.0*s_inf
-        return s_inf, s_sup
+def vec_to_mat(fc_vec):
 
-    def binary_search(predicate_stop, predicate_left, s_inf, s_sup):
-        s_mid = s_inf + (s_sup-s_inf)/2.0
-        while(not predicate_stop(s_mid)):
-            if (predicate_left(s_mid)):
-                s_sup = s_mid
-            else:
-                s_inf = s_mid
-            s_mid = s_inf + (s_sup-s_inf)/2.0
-        return s_mid
+    # symmetric matrix with unit diagonal, float32 for float32 input and float64 otherwise
+    return vec_to_full_matrix(np.asarray(fc_vec), diagonal=1)
 
-    delta_thr = caseA(epsilon, 0.0)
 
-    if (delta == delta_thr):
-        alpha = 1.0
+def postprocess(fc_mean_mat_dp, bound, post_para_svd, method="auto"):
 
-    else:
-        if (delta > delta_thr):
-            predicate_stop_DT = lambda s : caseA(epsilon, s) >= delta
-            function_s_to_delta = lambda s : caseA(epsilon, s)
-            predicate_left_BS = lambda s : function_s_to_delta(s) > delta
-            function_s_to_alpha = lambda s : sqrt(1.0 + s/2.0) - sqrt(s/2.0)
+    # low-rank approximation keeping the top post_para_svd components
+    fc_mean_mat_dp_lowrank = low_rank_approx(fc_mean_mat_dp, post_para_svd, method)
 
-        else:
-            predicate_stop_DT = lambda s : caseB(epsilon, s) <= delta
-            function_s_to_delta = lambda s : caseB(epsilon, s)
-            predicate_left_BS = lambda s : function_s_to_delta(s) < delta
-            function_s_to_alpha = lambda s : sqrt(1.0 + s/2.0) + sqrt(s/2.0)
+    return clip_with_unit_diagonal(fc_mean_mat_dp_lowrank, bound)
 
-        predicate_stop_BS = lambda s : abs(function_s_to_delta(s) - delta) <= tol
 
-        s_inf, s_sup = doubling_trick(predicate_stop_DT, 0.0, 1.0)
-        s_final = binary_search(predicate_stop_BS, predicate_left_BS, s_inf, s_sup)
-        alpha = function_s_to_alpha(s_final)
+def clip_with_unit_diagonal(fc_mat, bound):
 
-    sigma = alpha*GS/sqrt(2.0*epsilon)
+    fc_mat = np.clip(fc_mat, -bound, bound)
+    fc_mat[range(len(fc_mat)), range(len(fc_mat))] = 1
 
-    return sigma
+    return fc_mat
 
 
-def noisy_mat(fc_mean_vec, bound, sigma2):
+def low_rank_approx(fc_mat, num_components, method="auto"):
 
-    fc_mean_vec_dp = np.clip(fc_mean_vec + np.random.normal(0, np.sqrt(sigma2), len(fc_mean_vec)), -bound, bound)
-    fc_mean_mat_dp = vec_to_mat(fc_mean_vec_dp)
+    """
+    Rank num_components approximation of the symmetric matrix fc_mat.
 
-    return fc_mean_mat_dp
+    For a symmetric matrix the singular values are the absolute eigenvalues, so keeping the top k
+    singular triplets is the same as keeping the k eigenpairs of largest magnitude. This avoids the
+    full SVD and the dense diagonal product.
 
+    method:
+      "auto": skip the decomposition when num_components >= n, use "eigsh" when k/n is small, else "eigh"
+      "eigsh": iterative solver for the top k eigenpairs only (scipy ARPACK)
+      "eigh": dense symmetric eigendecomposition
+      "svd": full SVD (reference implementation)
+    """
 
-def vec_to_mat(fc_vec):
+    num_nodes = len(fc_mat)
+    num_components = max(0, min(int(num_components), num_nodes))
 
-    num_nodes = int(np.roots([1, -1, -2*len(fc_vec)])[0])
-    ind = np.triu_indices(num_nodes, 1)
-    fc_mat = np.zeros((num_nodes, num_nodes))
-    fc_mat[ind] = fc_vec
-    fc_mat = fc_mat + fc_mat.T + np.diag([1]*num_nodes)
+    if method == "svd":
+        U, s, Vt = np.linalg.svd(fc_mat)
+        s[num_components:] = 0
+        return (U * s) @ Vt
 
-    return fc_mat
+    if num_components == 0:
+        return np.zeros_like(fc_mat)
+
+    if method == "auto":
+        if num_components == num_nodes:
+            return np.array(fc_mat, copy=True)
+        use_eigsh = num_nodes >= EIGSH_MIN_NODES and num_components <= EIGSH_MAX_FRACTION * num_nodes
+        method = "eigsh" if use_eigsh else "eigh"
+
+    if method == "eigsh" and num_components < num_nodes - 1:
+        # imported here, scipy.sparse.linalg adds noticeably to client start-up
+        from scipy.sparse.linalg import eigsh, ArpackNoConvergence
+        try:
+            eigvals, eigvecs = eigsh(fc_mat, k=num_components, which="LM")
+            return (eigvecs * eigvals) @ eigvecs.T
+        except ArpackNoConvergence:
+            pass
 
+    eigvals, eigvecs = np.linalg.eigh(fc_mat)
+    top = np.argsort(np.abs(eigvals))[::-1][:num_components]
+    eigvals, eigvecs = eigvals[top], eigvecs[:, top]
 
-def postprocess(fc_mean_mat_dp, bound, post_para_svd):
+    return (eigvecs * eigvals) @ eigvecs.T
 
-    # SVD
-    U, s, Vt = np.linalg.svd(fc_mean_mat_dp)
-    s[post_para_svd:] = 0
-    fc_mean_mat_dp_lowrank = U @ np.diag(s) @ Vt
 
-    fc_mean_mat_dp_svd = np.clip(fc_mean_mat_dp_lowrank, -bound, bound)
-    fc_mean_mat_dp_svd[range(len(fc_mean_mat_dp_svd)), range(len(fc_mean_mat_dp_svd))] = 1
+def low_rank_approximations(fc_mat, components_list):
+
+    """
+    low_rank_approx of the symmetric matrix fc_mat for every number of components in components_list,
+    from a single eigendecomposition. The approximations are built up in increasing order of components,
+    each adding the rank one terms of the next eigenpairs to the previous one.
+    """
 
-    return fc_mean_mat_dp_svd
+    num_nodes = len(fc_mat)
+    components_list = [max(0, min(int(num_components), num_nodes)) for num_components in components_list]
+    if len(set(components_list)) == 1:
+        low_rank_mat = low_rank_approx(fc_mat, components_list[0])
+        return [low_rank_mat] + [low_rank_mat.copy() for _ in components_list[1:]]
+
+    eigvals, eigvecs = np.linalg.eigh(fc_mat)
+    order = np.argsort(np.abs(eigvals))[::-1]
+    eigvals, eigvecs = eigvals[order], eigvecs[:, order]
+
+    approximations = {}
+    low_rank_mat = np.zeros_like(fc_mat)
+    done = 0
+    for num_components in sorted(set(components_list)):
+        low_rank_mat = low_rank_mat + (eigvecs[:, done:num_components] * eigvals[done:num_components]) \
+            @ eigvecs[:, done:num_components].T
+        approximations[num_components] = low_rank_mat
+        done = num_components
+
+    return [approximations[num_components].copy() for num_components in components_list]
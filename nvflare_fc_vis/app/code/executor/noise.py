@@ -0,0 +1,92 @@
+"""
+Gaussian noise for the DP mechanism, drawn from numpy Generators of its own instead of the global
+np.random state.
+
+Every task gets a SeedSequence; with a seed its streams are reproducible, keyed by job, site, round and the
+released privacy settings so that none of them ever share a stream. The noise is generated in fixed-size blocks, each from a child
+of the sequence, so large vectors can be filled by several threads (Generator releases the GIL) and
+the values do not depend on the number of threads.
+
+The seed reproduces the noise exactly, so it must stay with the site: whoever knows it can remove the noise.
+Two releases drawn from the same stream at different noise scales give away the pre-noise mean by
+differencing, which is why the stream depends on the privacy settings and the job. Even so a seed is for
+replaying one run and must not be reused for other releases.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+NOISE_BLOCK_SIZE = 1 << 18
+# below this many values the noise is generated on the calling thread
+PARALLEL_MIN_SIZE = 1 << 21
+MAX_NOISE_WORKERS = 8
+
+
+def noise_seed_sequence(seed=None, site_name: str = None, current_round: int = None, job_id: str = None,
+                        release=None) -> np.random.SeedSequence:
+    """
+    SeedSequence for one task. seed None draws fresh entropy from the OS; otherwise the stream is fixed by
+    (seed, job_id, site_name, current_round, release), for replaying a run. release describes the privacy
+    settings of what is released (e.g. the (epsilon, delta) pairs and the clipping bound), JSON-serializable.
+    """
+    spawn_key = (
+        key_hash(job_id),
+        key_hash(site_name),
+        0 if current_round is None else int(current_round) + 1,
+        key_hash(release),
+    )
+    return np.random.SeedSequence(seed, spawn_key=spawn_key)
+
+
+def key_hash(value) -> int:
+    """128-bit hash of a JSON-serializable value, stable across processes (unlike hash())."""
+    digest = hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).digest()
+    return int.from_bytes(digest[:16], "little")
+
+
+def standard_normal_fill(seed_sequence: np.random.SeedSequence, out: np.ndarray, workers: int = None) -> np.ndarray:
+    """
+    Fills out (C-contiguous, float64 or float32) with standard normal values, one block of NOISE_BLOCK_SIZE
+    per child of seed_sequence. Every call spawns new children, so repeated calls draw different noise.
+    """
+    flat = out.reshape(-1)
+    blocks = [flat[start:start + NOISE_BLOCK_SIZE] for start in range(0, flat.size, NOISE_BLOCK_SIZE)]
+    generators = [np.random.Generator(np.random.PCG64(child)) for child in seed_sequence.spawn(len(blocks))]
+
+    def fill(generator, block):
+        generator.standard_normal(out=block, dtype=block.dtype)
+
+    if workers is None:
+        workers = min(MAX_NOISE_WORKERS, os.cpu_count() or 1)
+    if flat.size < PARALLEL_MIN_SIZE or workers <= 1:
+        for generator, block in zip(generators, blocks):
+            fill(generator, block)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(fill, generators, blocks))
+    return out
+
+
+def add_clipped_noise(fc_mean_vec, bound, sigma, seed_sequence: np.random.SeedSequence = None, out=None,
+                      workers: int = None) -> np.ndarray:
+    """
+    clip(fc_mean_vec + N(0, sigma^2), -bound, bound), computed in place in out (allocated if None) so no
+    other full-size array is created. For several noise scales pass a 1-d sigma and an out with one row
+    per scale; every row is fc_mean_vec plus its own noise.
+    """
+    if seed_sequence is None:
+        seed_sequence = noise_seed_sequence()
+    if out is None:
+        out = np.empty(np.shape(fc_mean_vec), dtype=getattr(fc_mean_vec, "dtype", np.float64))
+    sigma = np.asarray(sigma, dtype=out.dtype)
+    if sigma.ndim == 1:
+        sigma = sigma[:, None]
+
+    standard_normal_fill(seed_sequence, out, workers)
+    out *= sigma
+    out += fc_mean_vec
+    np.clip(out, -bound, bound, out=out)
+    return out
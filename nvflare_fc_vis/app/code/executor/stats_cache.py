@@ -0,0 +1,113 @@
+"""
+Site-local cache of the pre-noise sufficient statistics (clipped mean and subject count).
+
+Entries live in a directory beside the site's data directory and are keyed by a content hash of the
+input file plus the clipping bound, so a changed cohort or bound is always recomputed. Only the
+statistics before the DP noise are cached; noise and post-processing are applied fresh on every run.
+
+Hashing reads the whole input file, about as long as computing the statistics, so the digest is stored
+in the cache directory with the file's (size, mtime_ns, inode) stamp and only recomputed when the stamp
+changes. A cache hit then costs a stat call and reading the entry.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+
+STATS_CACHE_SUFFIX = "_stats_cache"
+DIGEST_BLOCK_SIZE = 1 << 20
+# content digests of the input files by path, with the stamp they were computed for
+DIGESTS_FILENAME = "digests.json"
+
+
+def stats_cache_dir(data_dir_path: str) -> str:
+    return os.path.normpath(os.path.abspath(data_dir_path)) + STATS_CACHE_SUFFIX
+
+
+def file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(DIGEST_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stamp(file_path: str) -> list:
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def cached_file_digest(cache_dir: str, file_path: str) -> str:
+    """file_digest of file_path, computed again only if the file's stamp differs from the stored one."""
+    digests_path = os.path.join(cache_dir, DIGESTS_FILENAME)
+    file_path = os.path.abspath(file_path)
+    try:
+        with open(digests_path) as file:
+            digests = json.load(file)
+    except (OSError, ValueError):
+        digests = {}
+
+    stamp = file_stamp(file_path)
+    entry = digests.get(file_path)
+    if entry is not None and entry["stamp"] == stamp:
+        return entry["digest"]
+
+    digest = file_digest(file_path)
+    # a file written to while it was hashed may not match its digest, so that one is not stored
+    if file_stamp(file_path) == stamp:
+        digests[file_path] = {"stamp": stamp, "digest": digest}
+        write_cache_file(cache_dir, DIGESTS_FILENAME, json.dumps(digests).encode())
+    return digest
+
+
+def stats_cache_key(cache_dir: str, data_filepath: str, bound=None) -> str:
+    """
+    Key of the statistics of data_filepath clipped at bound. bound may be None when it is stored in
+    data_filepath itself (data.json), in which case the content hash already covers it.
+    """
+    key = hashlib.sha256(cached_file_digest(cache_dir, data_filepath).encode())
+    key.update(repr(None if bound is None else float(bound)).encode())
+    return key.hexdigest()
+
+
+def load_stats(cache_dir: str, key: str):
+    """
+    Output:
+      None on a miss, else (data, fc_mean_vec, num_subs) where data is the stored parameters dict
+      (or None if none were stored)
+    """
+    entry_path = os.path.join(cache_dir, key + ".npz")
+    if not os.path.exists(entry_path):
+        return None
+    try:
+        with np.load(entry_path) as entry:
+            data = json.loads(str(entry["data"])) if "data" in entry else None
+            return data, entry["fc_mean_vec"], int(entry["num_subs"])
+    except (OSError, ValueError, KeyError) as e:
+        print(f"ignoring unreadable statistics cache entry {entry_path}: {e}")
+        return None
+
+
+def store_stats(cache_dir: str, key: str, fc_mean_vec, num_subs: int, data: dict = None):
+    """Writes an entry (see write_cache_file)."""
+    arrays = {"fc_mean_vec": np.asarray(fc_mean_vec), "num_subs": np.asarray(num_subs)}
+    if data is not None:
+        arrays["data"] = np.asarray(json.dumps(data))
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    write_cache_file(cache_dir, key + ".npz", buffer.getvalue())
+
+
+def write_cache_file(cache_dir: str, file_name: str, content: bytes):
+    """Writes a file of the cache atomically; a read-only location only disables the cache."""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(content)
+        os.replace(tmp_path, os.path.join(cache_dir, file_name))
+    except OSError as e:
+        print(f"could not write statistics cache in {cache_dir}: {e}")
@@ -0,0 +1,24 @@
+"""
+Plotting of result matrices. Kept separate from average_executor so that matplotlib and nilearn are
+only imported when a plot is produced, not on every client start.
+
+Plots are rendered on the executor's background thread, so pyplot (global state, not thread-safe, and
+tied to the main thread by interactive backends) is never used: every plot draws on a Figure of its own
+with an Agg canvas. nilearn is given the axes and not the figure, as it looks up a figure's axes through
+pyplot, and the colorbar is added here for the same reason.
+"""
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+from nilearn import plotting
+
+
+def plot_matrix_to_file(fc_mat: np.ndarray, plot_file_path: str, dpi: int):
+    fig = Figure(figsize=(5, 3))
+    FigureCanvasAgg(fig)
+    axes = fig.add_subplot()
+    display = plotting.plot_matrix(fc_mat, axes=axes, vmax=1, vmin=-1, colorbar=False)
+    cax = make_axes_locatable(axes).append_axes("right", size="5%", pad=0.05)
+    fig.colorbar(display, cax=cax)
+    fig.savefig(plot_file_path, transparent=True, bbox_inches='tight', dpi=dpi)
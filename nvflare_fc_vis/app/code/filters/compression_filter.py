@@ -0,0 +1,60 @@
+from nvflare.apis.filter import Filter
+from nvflare.apis.fl_context import FLContext
+from nvflare.apis.shareable import ReservedHeaderKey, Shareable
+
+from common.compression import QUANTIZATIONS, check_codec, compress_payload, decompress_payload
+
+# Shareable header with the statistics of the last compression applied to it
+COMPRESSION_STATS_HEADER = "compression_stats"
+
+
+class CompressPayloadFilter(Filter):
+    def __init__(self, codec: str = "zlib", level: int = 6, quantization: str = None, max_error: float = 1e-3):
+        """Compresses the packed matrices of outgoing task data or results. The filter returns a compressed
+        copy: task data is shared by all sites a task is sent to, and the server keeps using it.
+
+        Args:
+            codec: "zlib", or "lz4" if the lz4 package is installed.
+            level: zlib compression level.
+            quantization: None (lossless), "float16" or "uint8"; arrays whose quantization error would
+                exceed max_error are sent losslessly. Forwarded partial sums are never quantized.
+            max_error: largest absolute error quantization may introduce.
+        """
+        super().__init__()
+        check_codec(codec)
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"quantization must be one of {QUANTIZATIONS}, got {quantization!r}")
+        self.codec = codec
+        self.level = level
+        self.quantization = quantization
+        self.max_error = max_error
+
+    def process(self, shareable: Shareable, fl_ctx: FLContext) -> Shareable:
+        shareable, stats = compress_payload(shareable, self.codec, self.level, self.quantization, self.max_error)
+        if stats["arrays"]:
+            shareable = with_own_headers(shareable)
+            shareable.set_header(COMPRESSION_STATS_HEADER, stats)
+            self.log_info(
+                fl_ctx,
+                f"compressed {stats['arrays']} array(s) {stats['raw_bytes']} -> {stats['compressed_bytes']} bytes "
+                f"(ratio {stats['ratio']:.2f}) in {stats['seconds'] * 1000:.1f} ms",
+            )
+        return shareable
+
+
+class DecompressPayloadFilter(Filter):
+    """Restores matrices compressed by CompressPayloadFilter to the packed wire format."""
+
+    def process(self, shareable: Shareable, fl_ctx: FLContext) -> Shareable:
+        shareable, stats = decompress_payload(shareable)
+        if stats["arrays"]:
+            self.log_info(fl_ctx, f"decompressed {stats['arrays']} array(s) in {stats['seconds'] * 1000:.1f} ms")
+        return shareable
+
+
+def with_own_headers(shareable: Shareable) -> Shareable:
+    """A copy of shareable with a copy of its headers, so setting a header leaves shareable's own alone."""
+    copied = Shareable()
+    copied.update(shareable)
+    copied[ReservedHeaderKey.HEADERS] = dict(shareable.get(ReservedHeaderKey.HEADERS) or {})
+    return copied
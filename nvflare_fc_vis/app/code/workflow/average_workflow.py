@@ -1,10 +1,20 @@
+from nvflare.apis.client import Client
 from nvflare.apis.impl.controller import Controller, Task, ClientTask
 from nvflare.apis.fl_context import FLContext
 from nvflare.apis.signal import Signal
 from nvflare.apis.shareable import Shareable
 
+from common.constants import APPLIED_PARAMETERS_HEADER, CURRENT_ROUND_HEADER, GLOBAL_AVERAGE_ACK_HEADER, PERF_HEADER
+from common.profiling import StageProfiler, stage_seconds
 import os
 import json
+import math
+import pickle
+import tempfile
+import threading
+import time
+
+LATE_RESULT_POLICIES = ("next_round", "report")
 
 
 class AverageWorkflow(Controller):
@@ -20,7 +30,50 @@ class AverageWorkflow(Controller):
         task_check_period: float = 0.5,
         persist_every_n_rounds: int = 1,
         snapshot_every_n_rounds: int = 1,
+        resume: bool = True,
+        snapshot_name: str = "average_workflow",
+        quorum_fraction: float = 0.0,
+        response_deadline: float = 0,
+        late_result_policy: str = "next_round",
+        profile: bool = False,
+        computation_parameters: dict = None,
+        fuse_global_average: bool = False,
     ):
+        """
+        Args:
+            min_clients: minimum number of responses a broadcast waits for (subject to response_deadline).
+            wait_time_after_min_received: once the quorum has responded, seconds to keep waiting for the
+                remaining sites. A broadcast closes as soon as every site has responded.
+            num_rounds: number of rounds to run, starting at start_round.
+            persist_every_n_rounds: write the round's global average to the snapshot directory every n rounds
+                (0 disables it).
+            snapshot_every_n_rounds: snapshot the workflow and aggregator state every n rounds (0 disables it).
+            resume: continue from the last snapshot of an unfinished job with the same snapshot_name instead
+                of starting again at start_round. A snapshot written with a different configuration (rounds,
+                computation parameters, aggregation settings, see config_fingerprint) is not resumed.
+            snapshot_name: subdirectory of the snapshot directory; a restarted job has a new job id, so
+                snapshots are found by this name.
+            quorum_fraction: fraction of the connected sites (at least min_clients) after which the
+                wait_time_after_min_received grace period starts. The default 0 leaves it to min_clients; with
+                1.0 and no response_deadline a single hung site blocks the round.
+            response_deadline: seconds after which a broadcast is closed with whatever responses arrived
+                (0 waits without a deadline).
+            late_result_policy: what to do with site results that arrive after their round was closed:
+                "next_round" folds them into the next round's aggregate if that site has no result of its
+                own there, "report" only records them. Both are listed in late_results.json.
+            profile: time the server's stages and collect the sites' stage records (sites need profile
+                enabled on their executor too) into perf_round_<round>.json in the snapshot directory.
+            computation_parameters: parameters sent to the sites with every get_local_average_and_count task,
+                overriding those in the sites' data (epsilon, delta, pre_processing_bound,
+                post_processing_components, ...). Used by parameter sweeps, one job per setting. Sites
+                apply them only if they allow overrides, and never beyond their own privacy settings; a site
+                result that was not computed with them fails the job rather than being averaged in.
+            fuse_global_average: send a round's global average with the next round's
+                get_local_average_and_count task instead of broadcasting accept_global_average for it. Sites
+                store it before computing and acknowledge it in their result, so a round needs one broadcast
+                instead of two; only the last round's global average is broadcast on its own. A site that
+                misses a round's task does not receive the previous round's global average.
+        """
         super().__init__()
         self.aggregator_id = aggregator_id
         self.aggregator = None
@@ -33,7 +86,26 @@ class AverageWorkflow(Controller):
         self._task_check_period = task_check_period
         self._persist_every_n_rounds = persist_every_n_rounds
         self._snapshot_every_n_rounds = snapshot_every_n_rounds
-        pass
+        self._resume = resume
+        self._snapshot_name = snapshot_name
+        if late_result_policy not in LATE_RESULT_POLICIES:
+            raise ValueError(f"late_result_policy must be one of {LATE_RESULT_POLICIES}, got {late_result_policy!r}")
+        self._quorum_fraction = quorum_fraction
+        self._response_deadline = response_deadline
+        self._late_result_policy = late_result_policy
+        # results that arrived after their round was closed, waiting to be folded into the next round
+        self._late_results = []
+        # record of every late result and what happened to it
+        self._late_report = []
+        self._late_lock = threading.Lock()
+        self._profile = profile
+        self._round_profiler = StageProfiler(enabled=False)
+        self._perf_report = None
+        self._computation_parameters = computation_parameters or {}
+        self._fuse_global_average = fuse_global_average
+        # with fuse_global_average, {"round", "global_average"} of the round whose average is still to be sent
+        self._pending_global_average = None
+        self._config_fingerprint = None
 
     def start_controller(self, fl_ctx: FLContext) -> None:
         self.aggregator = self._engine.get_component(self.aggregator_id)
@@ -42,18 +114,68 @@ class AverageWorkflow(Controller):
         pass
 
     def control_flow(self, abort_signal: Signal, fl_ctx: FLContext) -> None:
-        fl_ctx.set_prop(key="CURRENT_ROUND", value=0)
-
         # load parameters.json and set to the context that will be shared with clients
         parameters_file_path = self.get_parameters_file_path()
-        computation_parameters = self.load_computation_parameters(parameters_file_path)
+        computation_parameters = {
+            **self.load_computation_parameters(parameters_file_path), **self._computation_parameters
+        }
 
         fl_ctx.set_prop(key="COMPUTATION_PARAMETERS", value=computation_parameters, private=False, sticky=True)
 
+        snapshot_dir = self.get_snapshot_dir_path()
+        first_round = self._start_round
+        last_round = self._start_round + self._num_rounds
+
+        self._config_fingerprint = self.config_fingerprint(computation_parameters)
+        snapshot = self.load_snapshot(snapshot_dir) if self._resume else None
+        if snapshot is not None and snapshot.get("config_fingerprint") != self._config_fingerprint:
+            self.log_warning(
+                fl_ctx, f"Not resuming from the snapshot in {snapshot_dir}: it was written with a different "
+                        f"configuration ({snapshot.get('config_fingerprint')}). Starting at round {first_round}."
+            )
+            snapshot = None
+        if snapshot is not None:
+            first_round = snapshot["next_round"]
+            self.aggregator.set_state(snapshot["aggregator_state"])
+            self._late_results = snapshot.get("late_results", [])
+            self._late_report = snapshot.get("late_report", [])
+            self._pending_global_average = snapshot.get("pending_global_average")
+            self.log_info(fl_ctx, f"Resuming from snapshot in {snapshot_dir} at round {first_round}.")
+
+        for current_round in range(first_round, last_round):
+            if abort_signal.triggered:
+                return
+
+            fl_ctx.set_prop(key="CURRENT_ROUND", value=current_round, private=True, sticky=True)
+            self.log_info(fl_ctx, f"Round {current_round} started.")
+
+            aggr_shareable = self.run_round(abort_signal, fl_ctx)
+            if abort_signal.triggered:
+                return
+            self.save_late_report(snapshot_dir)
+            self.save_perf_report(snapshot_dir, current_round)
+
+            rounds_done = current_round - self._start_round + 1
+            if self._persist_every_n_rounds > 0 and rounds_done % self._persist_every_n_rounds == 0:
+                self.save_round_output(snapshot_dir, current_round, aggr_shareable)
+            if (self._snapshot_every_n_rounds > 0 and rounds_done % self._snapshot_every_n_rounds == 0) \
+                    or current_round == last_round - 1:
+                self.save_snapshot(snapshot_dir, current_round + 1, completed=current_round == last_round - 1)
+
+    def run_round(self, abort_signal: Signal, fl_ctx: FLContext) -> Shareable:
+        current_round = fl_ctx.get_prop(key="CURRENT_ROUND")
+        profiler = self._round_profiler = StageProfiler(enabled=self._profile)
+        task_data = Shareable()
+        task_data.set_header(CURRENT_ROUND_HEADER, current_round)
+        if self._computation_parameters:
+            task_data["computation_parameters"] = self._computation_parameters
+        if self._pending_global_average is not None:
+            task_data["previous_global_average"] = self._pending_global_average
+
         # create the initial task
         get_local_average_task = Task(
             name="get_local_average_and_count",
-            data=Shareable(),
+            data=task_data,
             props={},
             timeout=self._train_timeout,
             # before_task_sent_cb=self._prepare_train_task_data,
@@ -61,45 +183,191 @@ class AverageWorkflow(Controller):
         )
 
         # broadcast the task to all clients and await their responses
-        self.broadcast_and_wait(
-            task=get_local_average_task,
-            min_responses=self._min_clients,
-            wait_time_after_min_received=self._wait_time_after_min_received,
-            fl_ctx=fl_ctx,
-            abort_signal=abort_signal,
-        )
+        with profiler.stage("broadcast_local_average"):
+            self.broadcast_with_deadline(get_local_average_task, fl_ctx, abort_signal)
+        if abort_signal.triggered:
+            return Shareable()
+        if self._pending_global_average is not None:
+            acks = get_local_average_task.props["global_average_acks"]
+            self.log_info(
+                fl_ctx, f"Global average of round {self._pending_global_average['round']} stored by "
+                        f"{len(acks)} of {len(self._engine.get_clients())} sites."
+            )
+            self._pending_global_average = None
+
+        # results of sites that missed the previous round count for this one
+        self.fold_late_results(fl_ctx)
 
-        # once the all responses are returned, start the aggregation process
+        # once the responses are collected, start the aggregation process
         self.log_info(fl_ctx, "Start aggregation.")
-        aggr_shareable = self.aggregator.aggregate(fl_ctx)
+        with profiler.stage("aggregate"):
+            aggr_shareable = self.aggregator.aggregate(fl_ctx)
         self.log_info(fl_ctx, "End aggregation.")
 
-        result = {"global_average": aggr_shareable.get("global_average", {})}
+        # the packed matrix is not printable, report the summary fields only
+        global_average = aggr_shareable.get("global_average", {}) or {}
+        result = {"global_average": summary_fields(global_average)}
         print(f"\n\n{'='*50}\nAggregated result: {result}\n{'='*50}\n\n")
 
-        # create a task to accept the global average
-        accept_global_average_task = Task(
-            name="accept_global_average",
-            data=aggr_shareable,
-            props={},
-            timeout=self._train_timeout,
-        )
+        global_average_records = {}
+        last_round = current_round == self._start_round + self._num_rounds - 1
+        if self._fuse_global_average and not last_round:
+            # sent with the next round's task
+            if global_average:
+                self._pending_global_average = {"round": current_round, "global_average": global_average}
+        else:
+            aggr_shareable.set_header(CURRENT_ROUND_HEADER, current_round)
+            # create a task to accept the global average
+            accept_global_average_task = Task(
+                name="accept_global_average",
+                data=aggr_shareable,
+                props={},
+                timeout=self._train_timeout,
+                result_received_cb=self._record_response,
+            )
+
+            # broadcast the global average to all clients
+            with profiler.stage("broadcast_global_average"):
+                self.broadcast_with_deadline(accept_global_average_task, fl_ctx, abort_signal)
+            global_average_records = accept_global_average_task.props["perf_records"]
+
+        if self._profile:
+            self._perf_report = perf_report(
+                current_round, profiler.record(), self.aggregator.pop_perf_records(current_round),
+                global_average_records,
+            )
+        return aggr_shareable
+
+    def broadcast_with_deadline(self, task: Task, fl_ctx: FLContext, abort_signal: Signal):
+        """
+        Broadcasts task and waits until one of:
+          - every connected site has responded (closes immediately, no grace period)
+          - the quorum has responded and wait_time_after_min_received has passed since it was reached
+          - response_deadline seconds have passed
+        The task is then cancelled; results that come in afterwards are handled as late results.
+        """
+        num_sites = len(self._engine.get_clients())
+        quorum = min(num_sites, max(self._min_clients, math.ceil(self._quorum_fraction * num_sites)))
+        task.props["responders"] = set()
+        task.props["perf_records"] = {}
+        task.props["global_average_acks"] = set()
+
+        # min_responses=0 makes the controller wait for all sites; closing early is decided here
+        self.broadcast(task=task, fl_ctx=fl_ctx, targets=None, min_responses=0, wait_time_after_min_received=0)
+
+        start_time = time.time()
+        quorum_time = None
+        while task.completion_status is None:
+            if abort_signal.triggered:
+                break
 
-        # broadcast the global average to all clients
-        self.broadcast_and_wait(
-            task=accept_global_average_task,
-            min_responses=self._min_clients,
-            wait_time_after_min_received=self._wait_time_after_min_received,
-            fl_ctx=fl_ctx,
-            abort_signal=abort_signal,
+            now = time.time()
+            num_responses = len(task.props["responders"])
+            if num_responses >= num_sites:
+                break
+            if num_responses >= quorum:
+                quorum_time = quorum_time or now
+                if now - quorum_time >= self._wait_time_after_min_received:
+                    break
+            if self._response_deadline > 0 and now - start_time >= self._response_deadline:
+                self.log_warning(
+                    fl_ctx, f"{task.name}: deadline reached with {num_responses} of {num_sites} responses."
+                )
+                break
+
+            time.sleep(self._task_check_period)
+
+        if task.completion_status is None:
+            self.cancel_task(task, fl_ctx=fl_ctx)
+        self.log_info(
+            fl_ctx, f"{task.name} closed after {time.time() - start_time:.2f}s "
+                    f"with {len(task.props['responders'])} of {num_sites} responses."
         )
 
+    def _record_response(self, client_task: ClientTask, fl_ctx: FLContext) -> None:
+        client_task.task.props["responders"].add(client_task.client.name)
+        if client_task.result.get_header(GLOBAL_AVERAGE_ACK_HEADER) is not None:
+            client_task.task.props["global_average_acks"].add(client_task.client.name)
+        if self._profile and client_task.task.name == "accept_global_average":
+            perf_record = client_task.result.get_header(PERF_HEADER)
+            if perf_record:
+                client_task.task.props["perf_records"][client_task.client.name] = perf_record
+
     def _accept_site_result(self, client_task: ClientTask, fl_ctx: FLContext) -> bool:
-        accepted = self.aggregator.accept(client_task.result, fl_ctx)
+        self._record_response(client_task, fl_ctx)
+        if not self.applied_computation_parameters(client_task.client.name, client_task.result, fl_ctx):
+            return False
+        with self._round_profiler.stage("accept"):
+            accepted = self.aggregator.accept(client_task.result, fl_ctx)
         return accepted
 
-    def process_result_of_unknown_task(self, task: Task, fl_ctx: FLContext) -> None:
-        pass
+    def applied_computation_parameters(self, site_name: str, result: Shareable, fl_ctx: FLContext) -> bool:
+        """
+        Whether the site computed result with the job's computation_parameters. If not (the site does not
+        allow overrides, or refused them), the job's results would silently be the sites' defaults under the
+        job's parameters, so the run is stopped with a system panic.
+        """
+        if not self._computation_parameters:
+            return True
+        applied = result.get_header(APPLIED_PARAMETERS_HEADER)
+        if applied == self._computation_parameters:
+            return True
+        self.system_panic(
+            f"{site_name} did not apply the job's computation_parameters {self._computation_parameters} "
+            f"(applied: {applied}, return code: {result.get_return_code()}); is allow_parameter_overrides "
+            f"enabled and are the parameters within the site's privacy settings?", fl_ctx
+        )
+        return False
+
+    def process_result_of_unknown_task(
+        self, client: Client, task_name: str, client_task_id: str, result: Shareable, fl_ctx: FLContext
+    ) -> None:
+        """Results of a cancelled task end up here; local averages are kept as late results."""
+        if task_name != "get_local_average_and_count":
+            return
+        if not self.applied_computation_parameters(client.name, result, fl_ctx):
+            return
+
+        late_result = {
+            "site": client.name,
+            "round": result.get_header(CURRENT_ROUND_HEADER),
+            "received_in_round": fl_ctx.get_prop(key="CURRENT_ROUND"),
+            "received_at": time.time(),
+        }
+        self.log_warning(fl_ctx, f"Late result from {client.name} for round {late_result['round']}.")
+        with self._late_lock:
+            if self._late_result_policy == "next_round":
+                self._late_results.append({**late_result, "result": result})
+            else:
+                self._late_report.append({**late_result, "status": "reported"})
+
+    def fold_late_results(self, fl_ctx: FLContext):
+        """Offers the pending late results to the aggregator for the current round."""
+        with self._late_lock:
+            late_results, self._late_results = self._late_results, []
+
+        current_round = fl_ctx.get_prop(key="CURRENT_ROUND")
+        for late_result in late_results:
+            # the aggregator rejects it if the site already contributed to this round
+            accepted = self.aggregator.accept(late_result.pop("result"), fl_ctx)
+            status = f"folded into round {current_round}" if accepted else "superseded by a newer result"
+            self._late_report.append({**late_result, "status": status})
+
+    def save_late_report(self, snapshot_dir: str):
+        with self._late_lock:
+            report = self._late_report + [
+                {**{key: value for key, value in late_result.items() if key != "result"}, "status": "pending"}
+                for late_result in self._late_results
+            ]
+        if report:
+            with open(os.path.join(snapshot_dir, "late_results.json"), "w") as file:
+                json.dump(report, file, indent=1)
+
+    def save_perf_report(self, snapshot_dir: str, current_round: int):
+        if self._perf_report is not None:
+            with open(os.path.join(snapshot_dir, f"perf_round_{current_round}.json"), "w") as file:
+                json.dump(self._perf_report, file, indent=1)
+            self._perf_report = None
 
     def get_parameters_file_path(self) -> str:
         """
@@ -130,3 +398,112 @@ class AverageWorkflow(Controller):
     def load_computation_parameters(self, parameters_file_path: str):
         with open(parameters_file_path, "r") as file:
             return json.load(file)
+
+    def get_snapshot_dir_path(self) -> str:
+        """
+        Determines the directory for round outputs and snapshots by checking if in production, simulator or
+        poc mode, the same way as the results directory on the clients.
+        """
+
+        production_path = os.getenv("SNAPSHOT_DIR")
+        simulator_base_path = os.path.abspath(os.path.join(os.getcwd(), "../test_results"))
+        poc_base_path = os.path.abspath(os.path.join(os.getcwd(), "../../../../test_results"))
+
+        if production_path:
+            snapshot_dir = os.path.join(production_path, self._snapshot_name)
+        elif os.path.exists(simulator_base_path):
+            snapshot_dir = os.path.join(simulator_base_path, "server", self._snapshot_name)
+        elif os.path.exists(poc_base_path):
+            snapshot_dir = os.path.join(poc_base_path, "server", self._snapshot_name)
+        else:
+            snapshot_dir = os.path.join(os.getcwd(), "snapshots", self._snapshot_name)
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        return snapshot_dir
+
+    def save_snapshot(self, snapshot_dir: str, next_round: int, completed: bool = False):
+        snapshot = {
+            "next_round": next_round,
+            "completed": completed,
+            "aggregator_state": self.aggregator.get_state(),
+            "late_results": list(self._late_results),
+            "late_report": list(self._late_report),
+            "pending_global_average": self._pending_global_average,
+            "config_fingerprint": self._config_fingerprint,
+        }
+        write_atomically(os.path.join(snapshot_dir, "snapshot.pkl"), pickle.dumps(snapshot))
+
+    def config_fingerprint(self, computation_parameters: dict) -> dict:
+        """The settings a resumed run has to share with the run that wrote the snapshot."""
+        return {
+            "start_round": self._start_round,
+            "num_rounds": self._num_rounds,
+            "computation_parameters": computation_parameters,
+            "late_result_policy": self._late_result_policy,
+            "fuse_global_average": self._fuse_global_average,
+            "aggregator": type(self.aggregator).__name__,
+            "streaming": getattr(self.aggregator, "streaming", None),
+        }
+
+    def load_snapshot(self, snapshot_dir: str):
+        """Returns the snapshot of an unfinished run, or None if there is none to resume from."""
+        snapshot_path = os.path.join(snapshot_dir, "snapshot.pkl")
+        if not os.path.exists(snapshot_path):
+            return None
+        with open(snapshot_path, "rb") as file:
+            snapshot = pickle.load(file)
+        if snapshot["completed"]:
+            return None
+        return snapshot
+
+    def save_round_output(self, snapshot_dir: str, current_round: int, aggr_shareable: Shareable):
+        round_output = {"round": current_round, "global_average": aggr_shareable.get("global_average", {})}
+        write_atomically(os.path.join(snapshot_dir, f"round_{current_round}.pkl"), pickle.dumps(round_output))
+
+
+def summary_fields(global_average: dict) -> dict:
+    """global_average without its matrices, in all variants of a multi-configuration result."""
+    summary = {key: value for key, value in global_average.items() if key not in ("dp_fc_mean", "variants")}
+    if "variants" in global_average:
+        summary["variants"] = [summary_fields(variant) for variant in global_average["variants"]]
+    return summary
+
+
+def perf_report(current_round: int, server_record: dict, site_records: dict, global_average_records: dict) -> dict:
+    """
+    Performance report of a round: the server's stages, the stage records of every site, the slowest site
+    and the round's critical path, i.e. the slowest site's stages, the rest of the first broadcast (transfer,
+    queueing and waiting for the other sites), the aggregation and the global average broadcast.
+    """
+    server_seconds = stage_seconds(server_record)
+    critical_path = []
+    slowest_site = None
+    if site_records:
+        slowest_site = max(site_records, key=lambda site_name: site_records[site_name]["total_seconds"])
+        slowest_record = site_records[slowest_site]
+        critical_path = [
+            {"name": f"{slowest_site}:{stage['name']}", "seconds": stage["seconds"]}
+            for stage in slowest_record["stages"]
+        ]
+        wait_seconds = server_seconds.get("broadcast_local_average", 0.0) - slowest_record["total_seconds"]
+        critical_path.append({"name": "transfer_and_wait", "seconds": max(wait_seconds, 0.0)})
+    critical_path += [
+        {"name": stage_name, "seconds": server_seconds.get(stage_name, 0.0)}
+        for stage_name in ("aggregate", "broadcast_global_average")
+    ]
+    return {
+        "round": current_round,
+        "server": {**server_record, "stage_seconds": server_seconds},
+        "sites": site_records,
+        "global_average_sites": global_average_records,
+        "slowest_site": slowest_site,
+        "critical_path": critical_path,
+    }
+
+
+def write_atomically(file_path: str, content: bytes):
+    """Writes through a temporary file and os.replace so a crash never leaves a truncated snapshot."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as file:
+        file.write(content)
+    os.replace(tmp_path, file_path)
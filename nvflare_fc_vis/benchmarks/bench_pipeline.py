@@ -0,0 +1,217 @@
+"""
+Benchmarks of the FC pipeline stages, called directly (no NVFlare services needed).
+
+For every (nodes, subjects, sites, format) combination synthetic sites are generated, then each stage of
+executor.local_average and aggregator.get_global_average is timed, its peak traced memory is recorded
+(tracemalloc, in a separate run so it does not distort the timings) and the payload size of a site
+result is measured. Results are written as JSON; --baseline compares against an earlier results file
+and exits non-zero when a stage got slower than --threshold times its baseline.
+
+The *_float32 stages run the float32 compute mode ("precision": "float32") and, where the result is
+deterministic, record max_abs_error_vs_float64 against the float64 stage on the same input. The sites'
+data is float64 by default (--dtype): on float32 data the float32 clipped mean is exact.
+
+Sites post-process to --components-fraction of the nodes (0.1 by default), so postprocess runs the
+low-rank solvers: eigsh from EIGSH_MIN_NODES nodes on, eigh below. A fraction of 1 keeps every
+component, which skips the decomposition.
+
+Usage:
+    python benchmarks/bench_pipeline.py --nodes 100 200 400 --subjects 10 100 1000 --sites 3 \
+        --formats json npy --output bench_results.json
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app", "code")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aggregator.get_global_average import get_global_average  # noqa: E402
+from executor.calibration import calibrate_analytic_gaussian, unit_sigma  # noqa: E402
+from executor.local_average import (  # noqa: E402
+    clipping_bound, data_clip, dp_fc_mean, get_local_average_and_count, load_site_data, noisy_mat,
+    postprocess, streaming_clipped_mean, vec_to_mat,
+)
+from synthetic_data import FORMATS, num_edges_for, write_sites  # noqa: E402
+
+# legacy list-based stages (data_clip, dp_fc_mean) are skipped above this many subjects x edges
+DEFAULT_MAX_LEGACY_ELEMENTS = 50_000_000
+# post_processing_components of the synthetic sites, as a fraction of the nodes
+DEFAULT_COMPONENTS_FRACTION = 0.1
+
+
+def measure(fn, track_memory: bool):
+    """Runs fn once for timing and, if track_memory, once more under tracemalloc for the peak."""
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+
+    peak_bytes = None
+    if track_memory:
+        tracemalloc.start()
+        fn()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, seconds, peak_bytes
+
+
+def bench_site(site_dir: str, track_memory: bool, max_legacy_elements: int):
+    """Times each local stage on one site. Returns (stage records, site result)."""
+    records = []
+
+    def stage(name, fn, reference=None):
+        result, seconds, peak_bytes = measure(fn, track_memory)
+        record = {"stage": name, "seconds": seconds, "peak_bytes": peak_bytes}
+        if reference is not None:
+            # accuracy loss of a float32 stage against its float64 counterpart
+            record["max_abs_error_vs_float64"] = float(np.max(np.abs(result.astype(np.float64) - reference)))
+        records.append(record)
+        return result
+
+    fc_vecs, data = stage("load", lambda: load_site_data(site_dir))
+    bound = clipping_bound(data)
+    num_subs, num_edges = len(fc_vecs), len(fc_vecs[0])
+
+    if num_subs * num_edges <= max_legacy_elements:
+        fc_vecs_clip = stage("data_clip", lambda: data_clip(fc_vecs, bound))
+        stage("dp_fc_mean", lambda: dp_fc_mean(fc_vecs_clip, bound, data["epsilon"], data["delta"]))
+        del fc_vecs_clip
+
+    fc_mean_vec = stage("streaming_clipped_mean", lambda: streaming_clipped_mean(fc_vecs, bound))
+
+    def calibrate():
+        unit_sigma.cache_clear()
+        return calibrate_analytic_gaussian(data["epsilon"], data["delta"], np.sqrt(bound**2*num_edges)/num_subs)
+
+    sigma = stage("calibration", calibrate)
+    fc_mean_mat_dp = stage("noisy_mat", lambda: noisy_mat(fc_mean_vec, bound, sigma**2))
+    stage("vec_to_mat", lambda: vec_to_mat(fc_mean_vec))
+    num_nodes = len(fc_mean_mat_dp)
+    num_components = data.get("post_processing_components", num_nodes)
+    fc_mean_mat_dp_svd = stage("postprocess", lambda: postprocess(fc_mean_mat_dp, bound, num_components))
+
+    # float32 mode, on the same inputs (the noise differs between precisions, so it is added in float64)
+    stage("streaming_clipped_mean_float32", lambda: streaming_clipped_mean(fc_vecs, bound, dtype=np.float32),
+          reference=fc_mean_vec)
+    fc_mean_mat_dp_32 = fc_mean_mat_dp.astype(np.float32)
+    stage("vec_to_mat_float32", lambda: vec_to_mat(fc_mean_vec.astype(np.float32)))
+    stage("postprocess_float32", lambda: postprocess(fc_mean_mat_dp_32, bound, num_components),
+          reference=fc_mean_mat_dp_svd)
+    stage("get_local_average_and_count_float32",
+          lambda: get_local_average_and_count(site_dir, overrides={"precision": "float32"}))
+
+    site_result = stage("get_local_average_and_count", lambda: get_local_average_and_count(site_dir))
+    for record in records:
+        record["payload_bytes"] = None
+    records[-1]["payload_bytes"] = len(pickle.dumps(site_result))
+
+    return records, site_result
+
+
+def bench_config(num_nodes: int, num_subjects: int, num_sites: int, data_format: str, track_memory: bool,
+                 max_legacy_elements: int, work_dir: str, components_fraction: float = DEFAULT_COMPONENTS_FRACTION,
+                 dtype: str = "float64"):
+    num_components = max(1, round(components_fraction * num_nodes))
+    config = {"nodes": num_nodes, "edges": num_edges_for(num_nodes), "subjects": num_subjects,
+              "sites": num_sites, "format": data_format, "components": num_components, "dtype": dtype}
+    config_dir = os.path.join(work_dir, f"n{num_nodes}_s{num_subjects}_k{num_sites}_{data_format}")
+    site_dirs = write_sites(config_dir, num_sites, num_nodes, num_subjects, data_format,
+                            parameters={"post_processing_components": num_components}, dtype=dtype)
+
+    records = []
+    site_results = []
+    for site_dir in site_dirs:
+        site_records, site_result = bench_site(site_dir, track_memory, max_legacy_elements)
+        for record in site_records:
+            records.append({**config, "site": os.path.basename(site_dir), **record})
+        site_results.append(site_result)
+
+    _, seconds, peak_bytes = measure(lambda: get_global_average(site_results), track_memory)
+    records.append({**config, "site": "server", "stage": "get_global_average", "seconds": seconds,
+                    "peak_bytes": peak_bytes, "payload_bytes": len(pickle.dumps(get_global_average(site_results)))})
+    return records
+
+
+def summarize(records):
+    """Mean seconds / max peak bytes per (config, stage), the unit compared across runs."""
+    summary = {}
+    for record in records:
+        key = "|".join(str(record[k]) for k in ("nodes", "subjects", "sites", "format", "components", "dtype", "stage"))
+        entry = summary.setdefault(key, {"seconds": [], "peak_bytes": None, "payload_bytes": None})
+        entry["seconds"].append(record["seconds"])
+        for field in ("peak_bytes", "payload_bytes", "max_abs_error_vs_float64"):
+            if record.get(field) is not None:
+                entry[field] = max(entry.get(field) or 0, record[field])
+    for entry in summary.values():
+        entry["seconds"] = sum(entry["seconds"]) / len(entry["seconds"])
+    return summary
+
+
+def find_regressions(summary, baseline_summary, threshold: float):
+    regressions = []
+    for key, entry in summary.items():
+        baseline = baseline_summary.get(key)
+        if baseline and baseline["seconds"] > 0 and entry["seconds"] > threshold * baseline["seconds"]:
+            regressions.append({"key": key, "seconds": entry["seconds"], "baseline_seconds": baseline["seconds"]})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[100, 200, 400])
+    parser.add_argument("--subjects", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--sites", type=int, nargs="+", default=[2])
+    parser.add_argument("--formats", choices=FORMATS, nargs="+", default=["json", "npy"])
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc peak memory runs")
+    parser.add_argument("--max-legacy-elements", type=int, default=DEFAULT_MAX_LEGACY_ELEMENTS)
+    parser.add_argument("--components-fraction", type=float, default=DEFAULT_COMPONENTS_FRACTION,
+                        help="post_processing_components of the sites as a fraction of the nodes")
+    parser.add_argument("--dtype", choices=("float32", "float64"), default="float64",
+                        help="dtype of the sites' FC vectors")
+    parser.add_argument("--work-dir", help="where to generate site data (default: a temporary directory)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown factor reported as a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        records = []
+        for num_nodes in args.nodes:
+            for num_subjects in args.subjects:
+                for num_sites in args.sites:
+                    for data_format in args.formats:
+                        print(f"nodes={num_nodes} subjects={num_subjects} sites={num_sites} format={data_format}")
+                        records.extend(bench_config(num_nodes, num_subjects, num_sites, data_format,
+                                                    not args.no_memory, args.max_legacy_elements, work_dir,
+                                                    args.components_fraction, args.dtype))
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "numpy": np.__version__,
+              "records": records, "summary": summarize(records)}
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline_report = json.load(f)
+        report["regressions"] = find_regressions(report["summary"], baseline_report["summary"], args.threshold)
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['key']}: {regression['seconds']:.4f}s "
+                  f"(baseline {regression['baseline_seconds']:.4f}s)")
+        exit_code = 1 if report["regressions"] else 0
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"results written to {args.output}")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
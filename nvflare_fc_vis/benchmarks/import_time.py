@@ -0,0 +1,81 @@
+"""
+Client cold-start benchmark: times `import executor.average_executor` (what an NVFlare client does before
+its first task) in fresh interpreters and checks that the plotting stack is not pulled in.
+
+Usage:
+    python benchmarks/import_time.py [--repeats 5] [--output import_time.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app", "code"))
+MODULE = "executor.average_executor"
+HEAVY_MODULES = ["matplotlib", "nilearn"]
+
+IMPORT_SNIPPET = f"""
+import json, sys, time
+start = time.perf_counter()
+import {MODULE}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def time_cold_import():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [APP_CODE_DIR, os.getenv("PYTHONPATH")])))
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_SNIPPET],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["slowest_imports"] = slowest_imports(completed.stderr)
+    return result
+
+
+def slowest_imports(importtime_log: str, top: int = 10):
+    """Parses `python -X importtime` output into the top packages by cumulative microseconds."""
+    entries = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented by two more spaces per level below the single space of a top-level one
+        if len(name) - len(name.lstrip()) == 1:
+            entries.append((int(cumulative), name.strip()))
+    entries.sort(reverse=True)
+    return [{"module": name, "cumulative_us": us} for us, name in entries[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    runs = [time_cold_import() for _ in range(args.repeats)]
+    seconds = [run["seconds"] for run in runs]
+    report = {
+        "module": MODULE,
+        "repeats": args.repeats,
+        "median_seconds": statistics.median(seconds),
+        "min_seconds": min(seconds),
+        "max_seconds": max(seconds),
+        "heavy_modules_loaded": sorted({m for run in runs for m in run["loaded"]}),
+        "slowest_imports": runs[-1]["slowest_imports"],
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if report["heavy_modules_loaded"]:
+        sys.exit(f"plotting modules imported at client start: {report['heavy_modules_loaded']}")
+
+
+if __name__ == "__main__":
+    main()
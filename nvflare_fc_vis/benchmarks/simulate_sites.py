@@ -0,0 +1,418 @@
+"""
+In-process multi-site harness for capacity planning of the server side.
+
+Runs AverageWorkflow.control_flow with the real AverageAggregator and one AverageExecutor per site, but
+without FLARE provisioning or one process per client: a stand-in engine provides the aggregator, and the
+workflow's task broadcasting is replaced by a local dispatcher that runs the site tasks concurrently on
+a thread or process pool. Task data and results are serialized with fobs as they would be on the wire.
+
+Reported per broadcast phase: wall-clock latency, site compute time (min/median/max), task data and
+result payload sizes, aggregator state size, plus aggregation time and the server's peak RSS. With
+--groups or --project the sites are aggregated through one IntermediateAggregator per group, and the
+report includes the deviation of the tree aggregate from the flat one.
+
+Usage:
+    python benchmarks/simulate_sites.py --sites 100 --nodes 200 --subjects 50 --pool process --workers 8
+"""
+import argparse
+import json
+import os
+import pickle
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app", "code")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nvflare.apis.fl_constant import FLContextKey, ReservedKey, ReturnCode  # noqa: E402
+from nvflare.apis.fl_context import FLContext  # noqa: E402
+from nvflare.apis.shareable import Shareable, make_reply  # noqa: E402
+from nvflare.apis.signal import Signal  # noqa: E402
+from nvflare.fuel.utils import fobs  # noqa: E402
+from nvflare.apis.utils.decomposers import flare_decomposers  # noqa: E402
+from nvflare.app_common.decomposers import common_decomposers  # noqa: E402
+
+from aggregator.average_aggregator import AverageAggregator  # noqa: E402
+from aggregator.get_global_average import get_global_average  # noqa: E402
+from aggregator.intermediate_aggregator import IntermediateAggregator, site_groups_from_project  # noqa: E402
+from common.packing import as_edge_vector  # noqa: E402
+from executor import average_executor  # noqa: E402
+from executor.average_executor import AverageExecutor  # noqa: E402
+from synthetic_data import FORMATS, write_sites  # noqa: E402
+from workflow.average_workflow import AverageWorkflow  # noqa: E402
+
+# outside the FLARE runtime nothing registers the decomposers fobs needs for Shareable and numpy arrays; this
+# runs on import, so also in every process pool worker
+flare_decomposers.register()
+common_decomposers.register()
+
+JOB_ID = "simulated_job"
+
+# site name -> (data dir, results dir), set in the main process and in every pool worker
+SITE_DIRS = {}
+
+
+class LocalEngine:
+    """The part of the server engine the workflow uses: component lookup and the client list."""
+
+    def __init__(self, components: dict, site_names):
+        self.components = components
+        self.clients = [SimpleNamespace(name=name) for name in site_names]
+
+    def get_component(self, component_id: str):
+        return self.components.get(component_id)
+
+    def get_clients(self):
+        return self.clients
+
+
+def init_site_dirs(site_dirs: dict):
+    """Points the executor's data/results lookups at the synthetic sites (pool initializer)."""
+    SITE_DIRS.update(site_dirs)
+    average_executor.get_data_dir_path = lambda fl_ctx: SITE_DIRS[fl_ctx.get_prop(FLContextKey.CLIENT_NAME)][0]
+    average_executor.get_results_dir_path = lambda fl_ctx: SITE_DIRS[fl_ctx.get_prop(FLContextKey.CLIENT_NAME)][1]
+
+
+def run_site_task(site_name: str, task_name: str, task_data: bytes, executor_args: dict, delay: float = 0):
+    """Executes one task as site_name would; returns (site name, serialized result, compute seconds)."""
+    fl_ctx = FLContext()
+    fl_ctx.set_prop(FLContextKey.CLIENT_NAME, site_name, private=False)
+    fl_ctx.set_prop(FLContextKey.CURRENT_RUN, JOB_ID, private=False)
+
+    executor = AverageExecutor(**executor_args)
+    start = time.perf_counter()
+    time.sleep(delay)
+    try:
+        result = executor.execute(task_name, fobs.loads(task_data), fl_ctx, Signal())
+    except Exception as e:
+        # the client runner replies with an execution exception, as FLARE does
+        print(f"{site_name}: {task_name} failed: {e!r}")
+        result = make_reply(ReturnCode.EXECUTION_EXCEPTION)
+    executor.wait_for_plots()
+    seconds = time.perf_counter() - start
+
+    return site_name, fobs.dumps(result if result is not None else Shareable()), seconds
+
+
+class SiteDispatcher:
+    """
+    Stands in for the controller's task dispatching: broadcast sends the task to every site on the pool and
+    returns, a collector thread feeds results to the task's result callback until the task is cancelled,
+    after which results are passed to process_result_of_unknown_task as FLARE does.
+    """
+
+    def __init__(self, workflow: AverageWorkflow, site_names, pool, executor_args: dict, site_delays: dict = None,
+                 site_groups: dict = None):
+        """site_groups ({site name: group}) enables tree aggregation: each group's results are pre-combined by
+        an IntermediateAggregator and the server only sees one contribution per group."""
+        self.workflow = workflow
+        self.site_names = list(site_names)
+        self.pool = pool
+        self.executor_args = executor_args
+        self.site_delays = site_delays or {}
+        self.site_groups = site_groups
+        self.group_aggregators = {group: IntermediateAggregator() for group in set((site_groups or {}).values())}
+        # site results per round, to check the tree aggregate against the flat one
+        self.site_results = {}
+        self.phases = []
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def broadcast(self, task, fl_ctx: FLContext, targets=None, min_responses: int = 1,
+                  wait_time_after_min_received: int = 0):
+        task_data = fobs.dumps(task.data)
+        phase = {
+            "task": task.name,
+            "round": fl_ctx.get_prop("CURRENT_ROUND"),
+            "sites": len(self.site_names),
+            "task_data_bytes": len(task_data),
+            "start": time.perf_counter(),
+            "site_seconds": [],
+            "result_bytes": [],
+            "accept_seconds": 0.0,
+            "late_results": 0,
+        }
+        task.props["phase"] = phase
+        self.phases.append(phase)
+
+        futures = [
+            self.pool.submit(run_site_task, site_name, task.name, task_data, self.executor_args,
+                             self.site_delays.get(site_name, 0))
+            for site_name in self.site_names
+        ]
+        collector = threading.Thread(target=self.collect, args=(task, futures, fl_ctx), daemon=True)
+        collector.start()
+        self.collectors.append(collector)
+
+    def collect(self, task, futures, fl_ctx: FLContext):
+        phase = task.props["phase"]
+        pending_sites = {}
+        for site_name in self.site_names:
+            group = self.site_groups[site_name] if self.site_groups else site_name
+            pending_sites[group] = pending_sites.get(group, 0) + 1
+
+        for future in as_completed(futures):
+            site_name, result_data, seconds = future.result()
+            result = fobs.loads(result_data)
+            result.set_peer_props({ReservedKey.IDENTITY_NAME: site_name})
+            with self.lock:
+                phase["site_seconds"].append(seconds)
+
+            if not self.site_groups:
+                self.deliver(task, site_name, result, len(result_data), fl_ctx)
+                continue
+
+            group = self.site_groups[site_name]
+            group_aggregator = self.group_aggregators[group]
+            group_aggregator.accept(result, fl_ctx)
+            if "result" in result:
+                self.site_results.setdefault(phase["round"], []).append(result["result"])
+            pending_sites[group] -= 1
+            if pending_sites[group] == 0:
+                group_result = group_aggregator.aggregate(fl_ctx)
+                group_result.set_peer_props({ReservedKey.IDENTITY_NAME: group})
+                self.deliver(task, group, group_result, len(fobs.dumps(group_result)), fl_ctx)
+
+        with self.lock:
+            if task.completion_status is None:
+                self.close(task, "OK")
+
+    def deliver(self, task, client_name: str, result: Shareable, result_size: int, fl_ctx: FLContext):
+        """Hands a result that reached the server to the task, or to the unknown-task path once it is closed."""
+        phase = task.props["phase"]
+        client = SimpleNamespace(name=client_name)
+        with self.lock:
+            phase["result_bytes"].append(result_size)
+            if task.completion_status is not None:
+                phase["late_results"] += 1
+                self.workflow.process_result_of_unknown_task(client, task.name, client_name, result, fl_ctx)
+                return
+            if task.result_received_cb is not None:
+                client_task = SimpleNamespace(client=client, task=task, result=result)
+                accept_start = time.perf_counter()
+                task.result_received_cb(client_task=client_task, fl_ctx=fl_ctx)
+                phase["accept_seconds"] += time.perf_counter() - accept_start
+
+    def cancel_task(self, task, completion_status="cancelled", fl_ctx: FLContext = None):
+        with self.lock:
+            self.close(task, completion_status)
+
+    def close(self, task, completion_status):
+        task.completion_status = completion_status
+        phase = task.props["phase"]
+        phase["seconds"] = time.perf_counter() - phase["start"]
+        phase["responses_in_time"] = len(phase["site_seconds"])
+        phase["completion_status"] = completion_status
+        phase["aggregator_state_bytes"] = aggregator_state_bytes(self.workflow.aggregator)
+
+    def report(self):
+        """Phase summaries, once every site task (including late ones) has finished."""
+        for collector in self.collectors:
+            collector.join()
+        phases = []
+        for phase in self.phases:
+            site_seconds, result_bytes = phase["site_seconds"], phase["result_bytes"]
+            phases.append({
+                **{key: value for key, value in phase.items() if key not in ("start", "site_seconds", "result_bytes")},
+                "site_seconds": {"min": min(site_seconds), "median": statistics.median(site_seconds),
+                                 "max": max(site_seconds)},
+                "result_bytes": {"total": sum(result_bytes), "max": max(result_bytes)},
+            })
+        return phases
+
+
+def aggregator_state_bytes(aggregator) -> int:
+    """Serialized size of what the aggregator holds for pending rounds."""
+    state = {key: value for key, value in vars(aggregator).items() if isinstance(value, dict)}
+    return len(pickle.dumps(state))
+
+
+def timed_aggregate(aggregator, timings: list, outputs: dict):
+    aggregate = aggregator.aggregate
+
+    def wrapper(fl_ctx):
+        start = time.perf_counter()
+        result = aggregate(fl_ctx)
+        timings.append(time.perf_counter() - start)
+        outputs[fl_ctx.get_prop("CURRENT_ROUND")] = result.get("global_average")
+        return result
+
+    return wrapper
+
+
+def tree_deviation(global_averages: dict, site_results: dict) -> dict:
+    """Max abs difference per round between the tree aggregate and the flat average of the same site results."""
+    deviations = {}
+    for current_round, results in site_results.items():
+        tree_average = global_averages.get(current_round)
+        if tree_average:
+            flat_average = get_global_average(results)
+            deviations[current_round] = max(
+                float(np.max(np.abs(as_edge_vector(tree_mean) - as_edge_vector(flat_mean))))
+                for tree_mean, flat_mean in zip(result_matrices(tree_average), result_matrices(flat_average))
+            )
+    return deviations
+
+
+def result_matrices(global_average: dict) -> list:
+    """The dp_fc_mean of every variant of a multi-configuration result, or the only one."""
+    if "variants" in global_average:
+        return [variant["dp_fc_mean"] for variant in global_average["variants"]]
+    return [global_average["dp_fc_mean"]]
+
+
+def simulate(site_dirs: dict, pool_kind: str = "thread", workers: int = None, executor_args: dict = None,
+             workflow_args: dict = None, aggregator_args: dict = None, site_delays: dict = None,
+             site_groups: dict = None):
+    """
+    Runs one job over site_dirs ({site name: (data dir, results dir)}) and returns the report.
+    site_delays ({site name: seconds}) makes sites stragglers, site_groups ({site name: group}) runs
+    tree aggregation with one intermediate aggregator per group.
+    """
+    executor_args = {"plot_mode": "none", **(executor_args or {})}
+    if site_groups:
+        ungrouped = [site_name for site_name in site_dirs if site_name not in site_groups]
+        if ungrouped:
+            raise ValueError(
+                f"no group for the simulated sites {ungrouped}; the grouping (e.g. the clients of --project) "
+                f"must cover every simulated site, site1 ... site{len(site_dirs)}"
+            )
+    init_site_dirs(site_dirs)
+
+    # in tree mode the server's direct clients are the intermediate aggregators
+    server_clients = sorted(set(site_groups.values())) if site_groups else list(site_dirs)
+    aggregator = AverageAggregator(**(aggregator_args or {}))
+    workflow = AverageWorkflow(**{"min_clients": len(server_clients), **(workflow_args or {})})
+    workflow._engine = LocalEngine({workflow.aggregator_id: aggregator}, server_clients)
+
+    pool_cls = ProcessPoolExecutor if pool_kind == "process" else ThreadPoolExecutor
+    pool_kwargs = {"initializer": init_site_dirs, "initargs": (site_dirs,)} if pool_kind == "process" else {}
+    aggregate_seconds = []
+    global_averages = {}
+
+    with pool_cls(max_workers=workers, **pool_kwargs) as pool:
+        dispatcher = SiteDispatcher(workflow, site_dirs, pool, executor_args, site_delays, site_groups)
+        workflow.broadcast = dispatcher.broadcast
+        workflow.cancel_task = dispatcher.cancel_task
+
+        fl_ctx = FLContext()
+        abort_signal = Signal()
+        # FLARE aborts the run on a system panic
+        workflow.system_panic = lambda reason, fl_ctx: abort_signal.trigger(reason)
+        workflow.start_controller(fl_ctx)
+        aggregator.aggregate = timed_aggregate(aggregator, aggregate_seconds, global_averages)
+
+        start = time.perf_counter()
+        workflow.control_flow(abort_signal, fl_ctx)
+        total_seconds = time.perf_counter() - start
+        workflow.stop_controller(fl_ctx)
+        phases = dispatcher.report()
+
+    return {
+        "sites": len(site_dirs),
+        "pool": pool_kind,
+        "workers": workers,
+        "total_seconds": total_seconds,
+        "aborted": abort_signal.value if abort_signal.triggered else None,
+        "aggregate_seconds": aggregate_seconds,
+        "server_peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "groups": len(server_clients) if site_groups else None,
+        "tree_max_abs_deviation": tree_deviation(global_averages, dispatcher.site_results) if site_groups else None,
+        "phases": phases,
+    }
+
+
+def load_perf_reports(snapshot_dir: str) -> list:
+    """The workflow's perf_round_<round>.json reports, in round order."""
+    file_names = [name for name in os.listdir(snapshot_dir) if name.startswith("perf_round_")]
+    reports = []
+    for file_name in sorted(file_names, key=lambda name: int(name[len("perf_round_"):-len(".json")])):
+        with open(os.path.join(snapshot_dir, file_name)) as f:
+            reports.append(json.load(f))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", type=int, default=50)
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--subjects", type=int, default=20)
+    parser.add_argument("--format", choices=FORMATS, default="npy")
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--min-clients", type=int, default=2)
+    parser.add_argument("--quorum-fraction", type=float, default=0.0)
+    parser.add_argument("--response-deadline", type=float, default=0)
+    parser.add_argument("--wait-after-quorum", type=float, default=10)
+    parser.add_argument("--groups", type=int, default=0, help="tree aggregation over this many site groups")
+    parser.add_argument("--project", help="tree aggregation grouping sites by org in this project.yaml")
+    parser.add_argument("--stragglers", type=int, default=0, help="number of sites delayed by --straggler-delay")
+    parser.add_argument("--straggler-delay", type=float, default=5.0)
+    parser.add_argument("--pool", choices=("thread", "process"), default="thread")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--work-dir", help="where to generate site data and results (default: a temporary directory)")
+    parser.add_argument("--profile", action="store_true", help="collect the per-round performance reports")
+    parser.add_argument("--fuse-global-average", action="store_true",
+                        help="send each global average with the next round's task (one broadcast per round)")
+    parser.add_argument("--sparse-top-k", type=int, default=None, help="sites send only their top k edges")
+    parser.add_argument("--sparse-threshold", type=float, default=None,
+                        help="sites send only edges with an absolute value of at least this")
+    parser.add_argument("--output", default="simulation_results.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        data_dirs = write_sites(os.path.join(work_dir, "data"), args.sites, args.nodes, args.subjects, args.format)
+        site_dirs = {}
+        for data_dir in data_dirs:
+            site_name = os.path.basename(data_dir)
+            results_dir = os.path.join(work_dir, "results", site_name)
+            os.makedirs(results_dir, exist_ok=True)
+            site_dirs[site_name] = (data_dir, results_dir)
+
+        parameters_file_path = os.path.join(work_dir, "parameters.json")
+        with open(parameters_file_path, "w") as f:
+            json.dump({}, f)
+        os.environ["PARAMETERS_FILE_PATH"] = parameters_file_path
+        snapshot_dir = os.path.join(work_dir, "snapshots")
+        os.environ["SNAPSHOT_DIR"] = snapshot_dir
+
+        workflow_args = {
+            "num_rounds": args.rounds,
+            "min_clients": args.min_clients,
+            "quorum_fraction": args.quorum_fraction,
+            "response_deadline": args.response_deadline,
+            "wait_time_after_min_received": args.wait_after_quorum,
+            "task_check_period": 0.05,
+            "profile": args.profile,
+            "fuse_global_average": args.fuse_global_average,
+        }
+        site_delays = {site_name: args.straggler_delay for site_name in list(site_dirs)[:args.stragglers]}
+        site_groups = None
+        if args.project:
+            site_groups = site_groups_from_project(args.project)
+        elif args.groups:
+            site_groups = {site_name: f"group{i % args.groups + 1}" for i, site_name in enumerate(site_dirs)}
+        executor_args = {
+            "profile": args.profile, "sparse_top_k": args.sparse_top_k, "sparse_threshold": args.sparse_threshold,
+        }
+        report = simulate(site_dirs, args.pool, args.workers, executor_args=executor_args,
+                          workflow_args=workflow_args, site_delays=site_delays, site_groups=site_groups)
+        if args.profile:
+            report["perf_reports"] = load_perf_reports(os.path.join(snapshot_dir, "average_workflow"))
+
+    report.update({"nodes": args.nodes, "subjects": args.subjects, "format": args.format, "rounds": args.rounds})
+    print(json.dumps(report, indent=1))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
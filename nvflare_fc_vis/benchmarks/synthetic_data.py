@@ -0,0 +1,122 @@
+"""
+Synthetic site datasets for the FC pipeline, in any of the input formats load_site_data understands.
+
+Subjects share a low-rank "group" connectivity pattern plus subject-level noise, squashed into (-1, 1)
+with tanh, which gives correlation-like values with realistic structure for the SVD post-processing.
+Subjects are generated and written in chunks, so large binary cohorts never have to fit in memory.
+
+Usage:
+    python benchmarks/synthetic_data.py --out synthetic_data --sites 3 --nodes 200 --subjects 100 --format npy
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app", "code")))
+
+from executor.local_average import DATA_JSON_FILENAME, HEADER_FILENAME, NPY_FILENAME, RAW_FILENAME  # noqa: E402
+
+FORMATS = ("json", "npy", "bin")
+GENERATION_CHUNK_SIZE = 64
+
+
+def num_edges_for(num_nodes: int) -> int:
+    return num_nodes * (num_nodes - 1) // 2
+
+
+def group_pattern(num_nodes: int, rank: int = 5, seed: int = 0) -> np.ndarray:
+    """Low-rank connectivity pattern shared by every subject of every site, as an edge vector."""
+    rng = np.random.default_rng(seed)
+    loadings = rng.normal(0, 1.0 / np.sqrt(rank), (num_nodes, rank))
+    pattern = loadings @ loadings.T
+    return pattern[np.triu_indices(num_nodes, 1)]
+
+
+def subject_chunks(num_nodes: int, num_subjects: int, seed: int, dtype="float32", noise=0.3):
+    """Yields (num_subjects_in_chunk x edges) arrays of synthetic FC vectors."""
+    rng = np.random.default_rng(seed)
+    pattern = group_pattern(num_nodes).astype(dtype)
+    for start in range(0, num_subjects, GENERATION_CHUNK_SIZE):
+        size = min(GENERATION_CHUNK_SIZE, num_subjects - start)
+        chunk = rng.standard_normal((size, len(pattern)), dtype=np.float32).astype(dtype, copy=False)
+        chunk *= noise
+        chunk += pattern
+        np.tanh(chunk, out=chunk)
+        yield chunk
+
+
+def write_site(site_dir: str, num_nodes: int, num_subjects: int, data_format: str = "json", seed: int = 0,
+               parameters: dict = None, dtype="float32") -> str:
+    """
+    Writes one site's data to site_dir. parameters (epsilon, delta, pre_processing_bound, ...) default to
+    epsilon=1, delta=1e-3. Returns the path of the file holding the subjects.
+    """
+    if data_format not in FORMATS:
+        raise ValueError(f"data_format must be one of {FORMATS}, got {data_format!r}")
+    os.makedirs(site_dir, exist_ok=True)
+    parameters = {"epsilon": 1.0, "delta": 1e-3, **(parameters or {})}
+    num_edges = num_edges_for(num_nodes)
+    chunks = subject_chunks(num_nodes, num_subjects, seed, dtype)
+
+    if data_format == "json":
+        data_path = os.path.join(site_dir, DATA_JSON_FILENAME)
+        fc_vecs = [row for chunk in chunks for row in chunk.astype(np.float64).tolist()]
+        with open(data_path, "w") as f:
+            json.dump({"fc_vecs": fc_vecs, **parameters}, f)
+        return data_path
+
+    if data_format == "npy":
+        data_path = os.path.join(site_dir, NPY_FILENAME)
+        fc_vecs = np.lib.format.open_memmap(data_path, mode="w+", dtype=dtype, shape=(num_subjects, num_edges))
+        start = 0
+        for chunk in chunks:
+            fc_vecs[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        fc_vecs.flush()
+        del fc_vecs
+    else:
+        data_path = os.path.join(site_dir, RAW_FILENAME)
+        with open(data_path, "wb") as f:
+            for chunk in chunks:
+                f.write(np.ascontiguousarray(chunk).tobytes())
+        parameters = {**parameters, "num_edges": num_edges, "dtype": np.dtype(dtype).name,
+                      "num_subjects": num_subjects}
+
+    with open(os.path.join(site_dir, HEADER_FILENAME), "w") as f:
+        json.dump(parameters, f)
+    return data_path
+
+
+def write_sites(out_dir: str, num_sites: int, num_nodes: int, num_subjects: int, data_format: str = "json",
+                parameters: dict = None, seed: int = 0, dtype="float32"):
+    """Writes site1..siteN under out_dir, the layout get_data_dir_path expects, and returns their paths."""
+    site_dirs = []
+    for site in range(num_sites):
+        site_dir = os.path.join(out_dir, f"site{site + 1}")
+        write_site(site_dir, num_nodes, num_subjects, data_format, seed + site, parameters, dtype)
+        site_dirs.append(site_dir)
+    return site_dirs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", required=True, help="directory to write site1..siteN into")
+    parser.add_argument("--sites", type=int, default=2)
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--subjects", type=int, default=50)
+    parser.add_argument("--format", choices=FORMATS, default="json")
+    parser.add_argument("--epsilon", type=float, default=1.0)
+    parser.add_argument("--delta", type=float, default=1e-3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    site_dirs = write_sites(args.out, args.sites, args.nodes, args.subjects, args.format,
+                            {"epsilon": args.epsilon, "delta": args.delta}, args.seed)
+    print("\n".join(site_dirs))
+
+
+if __name__ == "__main__":
+    main()
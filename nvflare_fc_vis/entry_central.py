@@ -1,36 +1,113 @@
+import json
+import os
+import socket
 import subprocess
+import time
 from nvflare.fuel.flare_api.flare_api import new_secure_session, Session
 from nvflare.apis.job_def import RunStatus, JobMetaKey
 
+from sweep import parameter_grid, write_sweep_jobs, run_sweep, write_results_index
+
+SERVER_HOST = os.getenv("SERVER_HOST", "localhost")
+ADMIN_PORT = int(os.getenv("ADMIN_PORT", "8003"))
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", "300"))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "3600"))
+# job status polling starts short, so short jobs are noticed quickly, and backs off for long ones
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 10.0
+POLL_BACKOFF = 1.5
+JOB_DIR = "/workspace/jobs/job/"
+# sweep mode: a grid of computation parameters, submitted as one job per point (see sweep.py)
+SWEEP_FILE = os.getenv("SWEEP_FILE")
+SWEEP_DIR = os.getenv("SWEEP_DIR", "/workspace/sweep_jobs")
+
 
 def start_server():
     subprocess.run(["/bin/bash", "/runKit/server/startup/start.sh"],
                    cwd="/runKit/server/startup")
 
 
-start_server()
+def with_backoff(attempt, description: str, timeout: float, min_delay: float = 0.1, max_delay: float = 2.0):
+    """Calls attempt until it returns a value other than None, sleeping with exponential backoff in between."""
+    deadline = time.time() + timeout
+    delay = min_delay
+    while True:
+        result = attempt()
+        if result is not None:
+            return result
+        if time.time() + delay > deadline:
+            raise TimeoutError(f"{description} did not succeed within {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
 
-session = new_secure_session(
-    "admin@admin.com",
-    "/runKit/admin/"
-)
 
-jobId = session.submit_job(
-    "/workspace/jobs/job/"
-)
+def admin_port_open():
+    try:
+        with socket.create_connection((SERVER_HOST, ADMIN_PORT), timeout=1):
+            return True
+    except OSError:
+        return None
 
 
-def my_callback(session: Session, job_id: str, job_meta, *cb_args, **cb_kwargs) -> bool:
-    job_status = job_meta[JobMetaKey.STATUS]
-    print(f"job status: {job_status}")
+def try_new_session():
+    try:
+        return new_secure_session(
+            "admin@admin.com",
+            "/runKit/admin/"
+        )
+    except Exception as e:
+        print(f"admin session not available yet: {e}")
+        return None
+
+
+def wait_for_job(session: Session, job_id: str, timeout: float) -> str:
+    """Polls the job's status on a growing interval until it is finished; returns the final status."""
+    deadline = time.time() + timeout
+    interval = MIN_POLL_INTERVAL
+    last_status = None
+    while time.time() < deadline:
+        job_status = session.get_job_meta(job_id)[JobMetaKey.STATUS]
+        if job_status != last_status:
+            print(f"job status: {job_status}")
+            last_status = job_status
+        if 'FINISHED' in job_status:
+            return job_status
+        time.sleep(interval)
+        interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+    raise TimeoutError(f"job {job_id} did not finish within {timeout}s (last status: {last_status})")
 
-    if 'FINISHED' in job_status:
-        print(f"job {job_id} finished, shutting down system")
-        session.shutdown("all")
-        return False
-    else:
-        return True
 
+start_time = time.time()
+start_server()
+with_backoff(admin_port_open, f"connecting to the admin port {SERVER_HOST}:{ADMIN_PORT}", STARTUP_TIMEOUT)
+ready_time = time.time()
+
+session = with_backoff(try_new_session, "creating the admin session", STARTUP_TIMEOUT, min_delay=0.5)
+
+# the server and clients are shut down even if waiting for the jobs fails or times out
+try:
+    if SWEEP_FILE:
+        with open(SWEEP_FILE) as sweep_file:
+            sweep = json.load(sweep_file)
+        concurrency = int(os.getenv("SWEEP_CONCURRENCY", sweep.get("concurrency", 1)))
+        sweep_jobs = write_sweep_jobs(JOB_DIR, SWEEP_DIR, parameter_grid(sweep["parameters"]))
+        submit_time = time.time()
+        print(f"server ready after {ready_time - start_time:.1f}s, submitting {len(sweep_jobs)} sweep jobs "
+              f"({concurrency} at a time) after {submit_time - start_time:.1f}s")
+
+        run_sweep(session, sweep_jobs, concurrency, JOB_TIMEOUT, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL, POLL_BACKOFF)
+        finish_time = time.time()
+        index_path = write_results_index(SWEEP_DIR, sweep_jobs)
+        print(f"sweep finished after {finish_time - submit_time:.1f}s, results index: {index_path}, shutting down system")
+    else:
+        jobId = session.submit_job(JOB_DIR)
+        submit_time = time.time()
+        print(f"server ready after {ready_time - start_time:.1f}s, job {jobId} submitted after {submit_time - start_time:.1f}s")
 
-session.monitor_job(
-    jobId, timeout=3600, poll_interval=10, cb=my_callback)
+        job_status = wait_for_job(session, jobId, JOB_TIMEOUT)
+        finish_time = time.time()
+        print(f"job {jobId} finished ({job_status}) after {finish_time - submit_time:.1f}s, shutting down system")
+finally:
+    shutdown_start = time.time()
+    session.shutdown("all")
+    print(f"shutdown took {time.time() - shutdown_start:.1f}s, total {time.time() - start_time:.1f}s")
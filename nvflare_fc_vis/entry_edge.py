@@ -1,28 +1,146 @@
+import ctypes
+import json
+import os
+import signal
 import subprocess
-import time
-import psutil
 import sys
+import threading
+import time
+
+START_SCRIPT = "/workspace/runKit/startup/start.sh"
+# written by the kit's sub_start.sh with the pid of the nvflare client process (rewritten when it restarts it)
+CLIENT_PID_FILE = os.getenv("CLIENT_PID_FILE", "/workspace/runKit/pid.fl")
+# prctl option that makes orphaned descendants get re-parented to this process instead of init
+PR_SET_CHILD_SUBREAPER = 36
+FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+
+def become_subreaper() -> bool:
+    """
+    start.sh puts the nvflare client in the background and exits right away. As a child subreaper this
+    process inherits the client when start.sh exits, so it can wait for it with waitpid. Linux only.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def forward_signals(pgid: int):
+    """Passes shutdown signals on to the launched process group, so the client can stop cleanly."""
+    def handler(signum, frame):
+        print(f"Forwarding signal {signal.Signals(signum).name} to process group {pgid}")
+        try:
+            os.killpg(pgid, signum)
+        except ProcessLookupError:
+            pass
+
+    for signum in FORWARDED_SIGNALS:
+        signal.signal(signum, handler)
+
+
+def read_pid(pid_file_path: str):
+    try:
+        with open(pid_file_path) as pid_file:
+            return int(pid_file.read().strip())
+    except (OSError, ValueError):
+        return None
 
 
-print("Starting the shell script...")
-subprocess.Popen(["/bin/bash", "/workspace/runKit/startup/start.sh"])
+def wait_for_descendants(launched_pid: int, client_pid_file: str = CLIENT_PID_FILE) -> int:
+    """
+    Reaps children, including re-parented descendants, until none are left. Returns the exit code of the
+    nvflare client, i.e. of the last exited process whose pid was in client_pid_file, or of the launched
+    process if the client was never seen. Other descendants are only reaped.
+    """
+    client_exit_code = None
+    launched_exit_code = 0
+    while True:
+        try:
+            # peek without reaping: until it is reaped the exited process stays a zombie, which the start
+            # scripts still see as running, so the pid file is not removed before it is read
+            exited_pid = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT).si_pid
+        except ChildProcessError:
+            return client_exit_code if client_exit_code is not None else launched_exit_code
+        is_client = exited_pid == read_pid(client_pid_file)
+        pid, status = os.waitpid(exited_pid, 0)
+        exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if is_client:
+            client_exit_code = exit_code
+            print(f"nvflare client {pid} exited with code {exit_code}")
+        else:
+            print(f"Process {pid} exited with code {exit_code}")
+        if pid == launched_pid:
+            launched_exit_code = exit_code
 
 
-time.sleep(10)
+def wait_for_process_group(process: subprocess.Popen, pgid: int, check_period: float = 1.0) -> int:
+    """Fallback without subreaper support: waits for start.sh, then until its process group is empty."""
+    exit_code = process.wait()
+    print(f"Process {process.pid} exited with code {exit_code}")
+    while True:
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return exit_code
+        except PermissionError:
+            pass
+        time.sleep(check_period)
 
-print("Polling for nvflare process and printing process details for debugging...")
-while True:
-    process_found = False
-    for proc in psutil.process_iter(attrs=['cmdline']):
-        cmdline = ' '.join(proc.info['cmdline']
-                           ) if proc.info['cmdline'] else ''
-        if 'nvflare' in cmdline:
-            process_found = True
-            print("nvflare process is running...")
-            break
 
-    if process_found:
-        time.sleep(10)
+def sample_metrics(metrics_file_path: str, interval: float, stop: threading.Event):
+    """Appends CPU and RSS of this process's descendants to metrics_file_path (JSON lines) every interval s."""
+    import psutil
+
+    supervisor = psutil.Process()
+    tracked = {}
+    with open(metrics_file_path, "a") as metrics_file:
+        while not stop.wait(interval):
+            cpu_percent, rss_bytes = 0.0, 0
+            children = supervisor.children(recursive=True)
+            # cpu_percent is measured since the previous call, so the Process objects are kept between samples
+            tracked = {child.pid: tracked.get(child.pid, child) for child in children}
+            for process in tracked.values():
+                try:
+                    cpu_percent += process.cpu_percent()
+                    rss_bytes += process.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+            metrics_file.write(json.dumps({
+                "time": time.time(), "processes": len(tracked), "cpu_percent": cpu_percent, "rss_bytes": rss_bytes,
+            }) + "\n")
+            metrics_file.flush()
+
+
+def main():
+    subreaper = become_subreaper()
+
+    print("Starting the shell script...")
+    # a session of its own gives the launched tree a process group that signals can be forwarded to
+    process = subprocess.Popen(["/bin/bash", START_SCRIPT], start_new_session=True)
+    pgid = process.pid
+    forward_signals(pgid)
+
+    stop_metrics = threading.Event()
+    metrics_file_path = os.getenv("SUPERVISOR_METRICS_FILE")
+    if metrics_file_path:
+        interval = float(os.getenv("SUPERVISOR_METRICS_INTERVAL", "5"))
+        threading.Thread(
+            target=sample_metrics, args=(metrics_file_path, interval, stop_metrics), daemon=True
+        ).start()
+
+    start_time = time.time()
+    if subreaper:
+        exit_code = wait_for_descendants(process.pid)
     else:
-        print("nvflare process is not running anymore or not found. Exiting.")
-        sys.exit(0)
+        print("Child subreaper not available, waiting on the process group instead.")
+        exit_code = wait_for_process_group(process, pgid)
+    stop_metrics.set()
+
+    print(f"nvflare processes exited after {time.time() - start_time:.1f}s with code {exit_code}. Exiting.")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
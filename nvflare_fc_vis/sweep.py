@@ -0,0 +1,147 @@
+"""
+Parameter sweeps: one job per point of a parameter grid, submitted to an already running server.
+
+A sweep file lists the values of each computation parameter, e.g.
+
+    {"parameters": {"epsilon": [1, 5, 10], "delta": [1e-5], "post_processing_components": [10, 50]},
+     "concurrency": 2}
+
+Each point becomes a copy of the job folder whose AverageWorkflow sends the point to the sites as
+computation_parameters (overriding the sites' own) and snapshots under a name of its own.
+
+A sweep only works if every site enables allow_parameter_overrides on its executor (it is off in the shipped
+client config) and every point is within every site's own epsilon, delta and clipping bound; the example
+epsilons 5 and 10 need sites that allow at least epsilon 10. A site that ignores or refuses a point fails
+that job (see AverageWorkflow computation_parameters), and the index only lists a point's results as
+"completed" if its job finished with FINISHED:COMPLETED.
+"""
+import copy
+import itertools
+import json
+import os
+import shutil
+import time
+
+from nvflare.apis.job_def import JobMetaKey, RunStatus
+
+SERVER_CONFIG = os.path.join("app", "config", "config_fed_server.json")
+WORKFLOW_PATH = "workflow.average_workflow.AverageWorkflow"
+
+
+def parameter_grid(parameters: dict) -> list:
+    """All combinations of the listed values, as one dict per point."""
+    names = sorted(parameters)
+    return [dict(zip(names, values)) for values in itertools.product(*(parameters[name] for name in names))]
+
+
+def sweep_job_name(index: int, point: dict) -> str:
+    return f"sweep_{index:03d}_" + "_".join(f"{name}={value}" for name, value in sorted(point.items()))
+
+
+def write_sweep_jobs(template_job_dir: str, sweep_dir: str, points: list) -> list:
+    """
+    Writes one job folder per point under sweep_dir, copied from template_job_dir.
+
+    Output:
+        list of {"job_name", "job_dir", "parameters"}
+    """
+    with open(os.path.join(template_job_dir, SERVER_CONFIG)) as file:
+        server_config = json.load(file)
+    with open(os.path.join(template_job_dir, "meta.json")) as file:
+        meta = json.load(file)
+
+    jobs = []
+    for index, point in enumerate(points):
+        job_name = sweep_job_name(index, point)
+        job_dir = os.path.join(sweep_dir, job_name)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        shutil.copytree(template_job_dir, job_dir)
+
+        job_config = copy.deepcopy(server_config)
+        for workflow in job_config["workflows"]:
+            if workflow["path"] == WORKFLOW_PATH:
+                workflow["args"]["computation_parameters"] = point
+                # snapshots are found by name, every point needs its own so it never resumes another's
+                workflow["args"]["snapshot_name"] = job_name
+        with open(os.path.join(job_dir, SERVER_CONFIG), "w") as file:
+            json.dump(job_config, file, indent=2)
+        with open(os.path.join(job_dir, "meta.json"), "w") as file:
+            json.dump({**meta, "name": job_name}, file, indent=2)
+
+        jobs.append({"job_name": job_name, "job_dir": job_dir, "parameters": point})
+    return jobs
+
+
+def run_sweep(session, jobs: list, concurrency: int = 1, timeout: float = 3600, min_poll_interval: float = 0.5,
+              max_poll_interval: float = 10.0, poll_backoff: float = 1.5) -> list:
+    """
+    Submits jobs with at most concurrency of them running at a time and tracks all of them until they are
+    finished. The poll interval is reset to min_poll_interval whenever a job finishes or is submitted.
+    timeout applies to each job from its submission: a job still running after timeout seconds is aborted
+    and marked TIMEOUT, and the next one takes its place.
+
+    Output:
+        the jobs, each with job_id, status, submitted_at, finished_at and seconds added
+    """
+    pending = list(jobs)
+    running = []
+    interval = min_poll_interval
+
+    while pending or running:
+        while pending and len(running) < concurrency:
+            job = pending.pop(0)
+            job["job_id"] = session.submit_job(job["job_dir"])
+            job["submitted_at"] = time.time()
+            print(f"submitted {job['job_name']} as job {job['job_id']}")
+            running.append(job)
+            interval = min_poll_interval
+
+        time.sleep(interval)
+        interval = min(interval * poll_backoff, max_poll_interval)
+
+        for job in list(running):
+            job_status = session.get_job_meta(job["job_id"])[JobMetaKey.STATUS]
+            if "FINISHED" in job_status:
+                job["status"] = job_status
+                job["finished_at"] = time.time()
+                job["seconds"] = job["finished_at"] - job["submitted_at"]
+                print(f"job {job['job_id']} ({job['job_name']}) finished ({job_status}) after {job['seconds']:.1f}s")
+                running.remove(job)
+                interval = min_poll_interval
+            elif time.time() - job["submitted_at"] > timeout:
+                print(f"job {job['job_id']} ({job['job_name']}) did not finish within {timeout}s, aborting it")
+                session.abort_job(job["job_id"])
+                job["status"] = "TIMEOUT"
+                running.remove(job)
+                interval = min_poll_interval
+
+    return jobs
+
+
+def write_results_index(sweep_dir: str, jobs: list) -> str:
+    """
+    Writes index.json mapping every point to its job. The sites' results are under the job id in their
+    results directories and the server's round outputs under the job name in its snapshot directory.
+    Only points with "completed" set were computed with their parameters by every site; the others failed,
+    e.g. because a site does not allow or refused the overrides.
+    """
+    index_path = os.path.join(sweep_dir, "index.json")
+    for job in jobs:
+        if job.get("status") != RunStatus.FINISHED_COMPLETED:
+            print(f"sweep point {job['parameters']} has no results: job {job.get('job_id')} ({job['job_name']}) "
+                  f"ended with {job.get('status')}")
+    index = [
+        {
+            "job_name": job["job_name"],
+            "job_id": job.get("job_id"),
+            "parameters": job["parameters"],
+            "completed": job.get("status") == RunStatus.FINISHED_COMPLETED,
+            "status": job.get("status"),
+            "seconds": job.get("seconds"),
+            "snapshot_name": job["job_name"],
+        }
+        for job in jobs
+    ]
+    with open(index_path, "w") as file:
+        json.dump(index, file, indent=1)
+    return index_path